@@ -0,0 +1,66 @@
+import fcntl
+import hashlib
+import os
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+import appdirs
+
+from . import object_storage
+
+ARTIFACT_DIR = os.getenv('AIS_ARTIFACT_DIR', os.path.join(appdirs.user_cache_dir('ais_'), 'artifacts'))
+# Objects larger than one part are downloaded as parallel range requests
+PART_SIZE = int(os.getenv('AIS_ARTIFACT_PART_SIZE', 64 * 1024 * 1024))
+DOWNLOAD_THREADS = int(os.getenv('AIS_ARTIFACT_DOWNLOAD_THREADS', 8))
+CHUNK_SIZE = 1024 * 1024
+
+
+def fetch(object_path: str) -> tuple[str, str]:
+    """Returns the local copy of an object and its ETag, downloading it only when it changed"""
+    stat = object_storage.stat_object(object_path)
+    etag = stat.etag.strip('"')
+
+    object_dir = os.path.join(ARTIFACT_DIR, hashlib.sha256(object_path.encode()).hexdigest()[:16])
+    path = os.path.join(object_dir, etag, os.path.basename(object_path))
+    os.makedirs(object_dir, exist_ok=True)
+
+    # Other workers may be downloading the same object
+    with open(os.path.join(object_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if os.path.exists(path):
+            return path, etag
+
+        # Older versions of the object are not needed anymore
+        for entry in os.scandir(object_dir):
+            if entry.is_dir():
+                shutil.rmtree(entry.path)
+
+        os.makedirs(os.path.dirname(path))
+        partial_path = f'{path}.part'
+        download(object_path, stat.size, partial_path)
+        os.replace(partial_path, path)
+
+    return path, etag
+
+
+def download(object_path: str, size: int, path: str):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+
+        def download_range(offset: int):
+            res = object_storage.get_object(object_path, offset, min(PART_SIZE, size - offset))
+            try:
+                for chunk in res.stream(CHUNK_SIZE):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+            finally:
+                res.close()
+                res.release_conn()
+
+        with ThreadPoolExecutor(DOWNLOAD_THREADS) as pool:
+            list(pool.map(download_range, range(0, size, PART_SIZE)))
+    finally:
+        os.close(fd)
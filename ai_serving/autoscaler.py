@@ -0,0 +1,112 @@
+import math
+import os
+import threading
+import time
+
+from sqlalchemy import func
+
+from . import cpu_manager, models, routing
+from .database import SessionLocal
+from .residency import ResidencyManager
+
+# Seconds between scaling decisions
+AUTOSCALE_INTERVAL = float(os.getenv('AIS_AUTOSCALE_INTERVAL', 5))
+# Waiting jobs of a model each of its replicas is expected to keep up with
+TARGET_BACKLOG = int(os.getenv('AIS_TARGET_BACKLOG', 4))
+# Seconds demand must stay below the current replicas before they are reduced
+SCALE_DOWN_DELAY = float(os.getenv('AIS_SCALE_DOWN_DELAY', 60))
+# Replicas of all models in one worker process together, one core each. Its share of the cores unless set
+MAX_TOTAL_REPLICAS = int(os.getenv('AIS_MAX_TOTAL_REPLICAS', 0))
+
+WAITING = (models.JobStatus.PENDING, models.JobStatus.PREPROCESSED)
+
+
+class Autoscaler:
+    """Scales the replicas of loaded models with their backlog
+
+    A model gets a replica per TARGET_BACKLOG waiting jobs, and one more while every
+    replica is busy. Replicas are added right away as long as cores and memory allow,
+    busiest models first, but only removed once demand stayed lower for
+    SCALE_DOWN_DELAY seconds. Idle models go down to zero through eviction.
+    """
+
+    def __init__(self, model_workers: ResidencyManager):
+        self.model_workers = model_workers
+        self.low_since: dict[int, float] = {}
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(AUTOSCALE_INTERVAL)
+            try:
+                self.step()
+            except Exception as e:
+                print(f'Failed to autoscale models: {e!r}')
+
+    def backlog(self, model_ids: list[int]) -> dict[int, int]:
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(models.Job.model_id, func.count())
+                .filter(models.Job.model_id.in_(model_ids), models.Job.status.in_(WAITING))
+                .group_by(models.Job.model_id)
+                .all()
+            )
+        finally:
+            db.close()
+        backlog = dict.fromkeys(model_ids, 0)
+        backlog.update(rows)
+
+        if routing.client is not None:
+            for model_id in model_ids:
+                backlog[model_id] += routing.queue_length(routing.queue_name(model_id))
+        return backlog
+
+    def demand(self, model_worker, backlog: int) -> int:
+        replicas = math.ceil(backlog / TARGET_BACKLOG)
+        if backlog and model_worker.inflight >= model_worker.replicas:
+            replicas = max(replicas, model_worker.replicas + 1)
+        return max(1, min(replicas, model_worker.max_replicas))
+
+    def step(self):
+        with self.model_workers.lock:
+            resident = list(self.model_workers.model_workers.values())
+        model_workers = [model_worker for model_worker in resident if model_worker.max_replicas > 1]
+        if not model_workers:
+            return
+
+        backlog = self.backlog([model_worker.model.id for model_worker in model_workers])
+        total = sum(model_worker.replicas for model_worker in resident)
+        memory = sum(model_worker.memory() for model_worker in resident)
+        now = time.time()
+
+        for model_worker in sorted(model_workers, key=lambda w: backlog[w.model.id], reverse=True):
+            model_id = model_worker.model.id
+            current = model_worker.replicas
+            wanted = self.demand(model_worker, backlog[model_id])
+
+            if wanted > current:
+                self.low_since.pop(model_id, None)
+                if memory >= self.model_workers.budget:
+                    continue
+                wanted = min(wanted, current + (MAX_TOTAL_REPLICAS or len(cpu_manager.cpus)) - total)
+                if wanted <= current:
+                    continue
+            elif wanted < current:
+                # Hysteresis, short dips in load keep the replicas
+                low_since = self.low_since.setdefault(model_id, now)
+                if now - low_since < SCALE_DOWN_DELAY:
+                    continue
+            else:
+                self.low_since.pop(model_id, None)
+                continue
+
+            if model_worker.stopping.is_set():
+                continue
+            self.low_since.pop(model_id, None)
+            try:
+                total += model_worker.scale(wanted) - current
+            except Exception as e:
+                print(f'Failed to scale model {model_id} to {wanted} replicas: {e!r}')
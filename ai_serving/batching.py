@@ -0,0 +1,157 @@
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+import numpy as np
+
+_STOP = object()
+
+PADDING_NONE = 'none'
+PADDING_PAD = 'pad'
+
+
+class Batcher:
+    """Groups concurrent inference calls of a model into one call
+
+    Calls are concatenated along axis 0 until `max_batch_size` rows are pending or the
+    oldest call waited `max_wait_ms`, and the outputs are split back per call. Calls
+    whose arrays differ in more than the leading dimension are never mixed, unless the
+    padding policy is 'pad', which zero-pads them to the largest shape in the batch. Their
+    outputs are cropped back on the axes their first input was padded on, where the
+    output has the padded size too, e.g. the height and width of segmentation masks.
+    """
+
+    def __init__(self, infer, max_batch_size: int = 8, max_wait_ms: float = 5,
+                 padding: str = PADDING_NONE, pad_value: float = 0):
+        if padding not in (PADDING_NONE, PADDING_PAD):
+            raise ValueError(f'Unknown padding policy: {padding}')
+
+        self.infer = infer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.padding = padding
+        self.pad_value = pad_value
+
+        self.queue = queue.Queue()
+        self.carry = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, inputs: list[np.ndarray]) -> Future:
+        future = Future()
+        self.queue.put((inputs, future))
+        return future
+
+    def stop(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            if self.carry is not None:
+                first, self.carry = self.carry, None
+            else:
+                first = self.queue.get()
+            if first is _STOP:
+                return
+
+            batch = [first]
+            rows = self.rows(first[0])
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP or rows + self.rows(item[0]) > self.max_batch_size:
+                    # Goes first into the next batch
+                    self.carry = item
+                    break
+                batch.append(item)
+                rows += self.rows(item[0])
+
+            for group in self.group(batch):
+                self.run_group(group)
+
+    def rows(self, inputs: list[np.ndarray]) -> int:
+        if not inputs or inputs[0].ndim == 0:
+            return 1
+        return inputs[0].shape[0]
+
+    def key(self, inputs: list[np.ndarray]):
+        if any(array.ndim == 0 for array in inputs):
+            # Scalars cannot be concatenated, run alone
+            return id(inputs)
+        if self.padding == PADDING_PAD:
+            return tuple((array.dtype.str, array.ndim) for array in inputs)
+        return tuple((array.dtype.str, array.shape[1:]) for array in inputs)
+
+    def group(self, batch: list) -> list[list]:
+        groups = {}
+        for item in batch:
+            groups.setdefault(self.key(item[0]), []).append(item)
+        return list(groups.values())
+
+    def pad(self, arrays: list[np.ndarray]) -> list[np.ndarray]:
+        shape = np.max([array.shape[1:] for array in arrays], axis=0)
+        return [
+            np.pad(
+                array,
+                [(0, 0)] + [(0, int(size - current)) for size, current in zip(shape, array.shape[1:])],
+                constant_values=self.pad_value,
+            )
+            for array in arrays
+        ]
+
+    def crop(self, output: np.ndarray, shape: tuple, padded: tuple) -> np.ndarray:
+        index = tuple(
+            slice(0, shape[axis])
+            if axis < len(shape) and shape[axis] < padded[axis] == output.shape[axis] else slice(None)
+            for axis in range(output.ndim)
+        )
+        return output[index]
+
+    def run_group(self, group: list):
+        futures = [future for _, future in group]
+        try:
+            if len(group) == 1:
+                futures[0].set_result(self.infer(group[0][0]))
+                return
+
+            inputs = []
+            for arrays in zip(*(item for item, _ in group)):
+                if self.padding == PADDING_PAD:
+                    arrays = self.pad(arrays)
+                inputs.append(np.concatenate(arrays, axis=0))
+
+            outputs = self.infer(inputs)
+
+            sizes = [self.rows(item) for item, _ in group]
+            total = sum(sizes)
+            offsets = np.cumsum(sizes)[:-1]
+            for output in outputs:
+                if output.ndim == 0 or output.shape[0] != total:
+                    raise RuntimeError(
+                        f'Cannot split output of shape {output.shape} into a batch of {total} rows'
+                    )
+            splits = [np.split(output, offsets) for output in outputs]
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if self.padding == PADDING_PAD:
+            shapes = [item[0].shape for item, _ in group]
+            splits = [
+                [self.crop(output, shape, inputs[0].shape) for output, shape in zip(split, shapes)]
+                for split in splits
+            ]
+        for i, future in enumerate(futures):
+            future.set_result([split[i] for split in splits])
@@ -0,0 +1,140 @@
+import os
+import threading
+
+from .procfs import session_pids
+
+# Cores the model processes of this node may use, e.g. "0-7,16-23"
+CPUS = os.getenv('AIS_CPUS', '')
+# Default policy of models without one in ais.json: 'dedicated', 'shared' or 'auto'
+CPU_POLICY = os.getenv('AIS_CPU_POLICY', 'auto')
+
+POLICY_DEDICATED = 'dedicated'
+POLICY_SHARED = 'shared'
+# Dedicated cores while the model runs more than one replica, the shared pool otherwise
+POLICY_AUTO = 'auto'
+
+# Thread pool sizes read by the common numeric runtimes, AIS_INTRA_OP_THREADS is meant for
+# the model itself, e.g. onnxruntime's SessionOptions.intra_op_num_threads
+THREAD_ENV = (
+    'AIS_INTRA_OP_THREADS',
+    'OMP_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+)
+
+
+def parse_cpus(spec: str) -> list[int]:
+    cpus = []
+    for part in filter(None, spec.split(',')):
+        start, _, end = part.partition('-')
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+cpus = parse_cpus(CPUS) if CPUS else sorted(os.sched_getaffinity(0))
+
+lock = threading.Lock()
+model_workers = {}  # model_id -> ModelWorker
+allocation: dict[int, list[int]] = {}  # model_id -> cores
+
+
+def partition(index: int, count: int):
+    # Worker processes of one node split its cores, each manages its own share
+    global cpus
+
+    share = max(1, len(cpus) // count)
+    start = index % count * share
+    cpus = cpus[start:start + share] or cpus[-share:]
+
+
+def policy(model_worker) -> tuple[str, int]:
+    config = model_worker.config.get('cpu', {})
+    name = config.get('policy', CPU_POLICY)
+    if name == POLICY_AUTO:
+        name = POLICY_DEDICATED if model_worker.replicas > 1 else POLICY_SHARED
+    if name not in (POLICY_DEDICATED, POLICY_SHARED):
+        raise ValueError(f'Unknown CPU policy: {name}')
+    # One core per replica unless configured
+    return name, config.get('cores', model_worker.replicas)
+
+
+def allocate():
+    dedicated = []
+    shared = []
+    for model_id, model_worker in model_workers.items():
+        name, cores = policy(model_worker)
+        if name == POLICY_DEDICATED:
+            dedicated.append((model_id, cores))
+        else:
+            shared.append(model_id)
+
+    # Keep a core for the shared models, and give every dedicated model at least one
+    available = len(cpus) - (1 if shared else 0)
+    wanted = sum(cores for _, cores in dedicated)
+    if wanted > available:
+        if available < len(dedicated):
+            # Not even a core each, everything shares
+            shared.extend(model_id for model_id, _ in dedicated)
+            dedicated = []
+        else:
+            dedicated = [(model_id, max(1, cores * available // wanted)) for model_id, cores in dedicated]
+
+    result = {}
+    offset = 0
+    for model_id, cores in dedicated:
+        result[model_id] = cpus[offset:offset + cores]
+        offset += cores
+    pool = cpus[offset:] or cpus
+    for model_id in shared:
+        result[model_id] = pool
+    return result
+
+
+def thread_env(model_worker) -> dict[str, str]:
+    # Threads per replica, read once by the model process when it starts
+    with lock:
+        model_workers[model_worker.model.id] = model_worker
+        allocation.update(allocate())
+        cores = allocation[model_worker.model.id]
+    threads = str(max(1, len(cores) // model_worker.replicas))
+    return dict.fromkeys(THREAD_ENV, threads)
+
+
+def pin(pid: int, cores: list[int]):
+    # Every thread of every process of the model, including forked replicas
+    for process in session_pids(pid):
+        try:
+            tids = os.listdir(f'/proc/{process}/task')
+        except FileNotFoundError:
+            continue
+        for tid in tids:
+            try:
+                os.sched_setaffinity(int(tid), cores)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+
+def rebalance():
+    with lock:
+        allocation.clear()
+        allocation.update(allocate())
+        pinned = [(model_workers[model_id], cores) for model_id, cores in allocation.items()]
+
+    for model_worker, cores in pinned:
+        process = getattr(model_worker, 'process', None)
+        if process is not None and process.poll() is None:
+            pin(process.pid, cores)
+
+
+def release(model_worker):
+    with lock:
+        model_workers.pop(model_worker.model.id, None)
+        allocation.pop(model_worker.model.id, None)
+    rebalance()
+
+
+def describe() -> dict:
+    with lock:
+        return {'cpus': cpus, 'allocation': dict(allocation)}
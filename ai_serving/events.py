@@ -0,0 +1,112 @@
+import asyncio
+import json
+import os
+
+import redis
+import redis.asyncio
+
+from . import models
+
+REDIS_URL = os.getenv('REDIS_URL')
+# Every change of a job's status is published here
+CHANNEL = 'ais:jobs:{job_id}'
+
+FINISHED = (models.JobStatus.COMPLETED, models.JobStatus.FAILED)
+# Handed to every subscription once the hub (re)subscribed, events before that may be lost
+RESYNC = {'resync': True}
+
+client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+
+def publish(job_id: int, status: models.JobStatus, **values):
+    if client is None:
+        return
+    event = {'id': job_id, 'status': status.value, **values}
+    try:
+        # Stage timestamps as in the job itself
+        client.publish(CHANNEL.format(job_id=job_id), json.dumps(event, default=lambda value: value.isoformat()))
+    except redis.RedisError as e:
+        # Followers still see the change when they read the job
+        print(f'Failed to publish status of job {job_id}: {e!r}')
+
+
+class Hub:
+    """Hands job events to the subscriptions of this process
+
+    A single redis connection receives the events of all jobs, however many clients
+    follow them. Events published while it (re)subscribes are lost, subscriptions get
+    RESYNC then and read the jobs they follow again.
+    """
+
+    def __init__(self):
+        self.listeners: dict[int, set[asyncio.Queue]] = {}
+        self.task = None
+
+    def start(self):
+        if self.task is None and REDIS_URL:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                async with redis.asyncio.from_url(REDIS_URL) as connection:
+                    pubsub = connection.pubsub()
+                    await pubsub.psubscribe(CHANNEL.format(job_id='*'))
+                    async for message in pubsub.listen():
+                        if message['type'] == 'psubscribe':
+                            for queue in set().union(*self.listeners.values()):
+                                queue.put_nowait(RESYNC)
+                            continue
+                        if message['type'] != 'pmessage':
+                            continue
+                        event = json.loads(message['data'])
+                        for queue in self.listeners.get(event['id'], ()):
+                            queue.put_nowait(event)
+            except Exception as e:
+                print(f'Lost job events, reconnecting: {e!r}')
+                await asyncio.sleep(1)
+
+    def follow(self, queue: asyncio.Queue, job_ids):
+        self.start()
+        for job_id in job_ids:
+            self.listeners.setdefault(job_id, set()).add(queue)
+
+    def unfollow(self, queue: asyncio.Queue, job_ids):
+        for job_id in job_ids:
+            queues = self.listeners.get(job_id)
+            if queues is None:
+                continue
+            queues.discard(queue)
+            if not queues:
+                del self.listeners[job_id]
+
+
+hub = Hub()
+
+
+class Subscription:
+    """Events of the jobs a client follows, used as an async context manager"""
+
+    def __init__(self, job_ids=()):
+        self.queue = asyncio.Queue()
+        self.job_ids = set()
+        self.follow(job_ids)
+
+    def follow(self, job_ids):
+        job_ids = set(job_ids) - self.job_ids
+        self.job_ids |= job_ids
+        hub.follow(self.queue, job_ids)
+
+    def unfollow(self, job_ids):
+        job_ids = set(job_ids) & self.job_ids
+        self.job_ids -= job_ids
+        hub.unfollow(self.queue, job_ids)
+
+    async def get(self, timeout: float | None = None) -> dict:
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.unfollow(set(self.job_ids))
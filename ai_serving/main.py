@@ -1,12 +1,53 @@
-from fastapi import Depends, FastAPI, HTTPException, Request, UploadFile
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import uuid
+
+from datetime import datetime, timedelta, timezone
+
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Query, Request, Response, UploadFile
+from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from sqlalchemy import extract, func, insert
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-from . import models, object_storage, schemas, tasks
+from . import events, metrics, models, object_storage, result_cache, routing, schemas, tasks
 from .database import engine, SessionLocal
+from .metrics import GaugeMetricFamily
+from .pagination import MAX_LIMIT, paginate, reject_skip
+
+# Largest input /predict accepts, larger ones go through /files/ and /jobs/
+PREDICT_MAX_BYTES = int(os.getenv('AIS_PREDICT_MAX_BYTES', 1 << 20))
+# Seconds /predict waits for the result
+PREDICT_TIMEOUT = float(os.getenv('AIS_PREDICT_TIMEOUT', 30))
+# Most jobs a single /jobs/batch request may create
+MAX_BATCH_SIZE = int(os.getenv('AIS_MAX_BATCH_SIZE', 50000))
+# Jobs published to the broker per connection checkout
+PUBLISH_CHUNK_SIZE = 1000
+# Longest ?wait= of GET /jobs/{job_id}
+MAX_WAIT = float(os.getenv('AIS_MAX_WAIT', 60))
+# Seconds between keep-alives of job event streams
+KEEPALIVE = 15
+
+# Durations GET /models/{model_id}/timings aggregates, between two timestamps of each job
+TIMINGS = {
+    'queue_wait': (models.Job.created_at, models.Job.preprocess_started_at),
+    'preprocess': (models.Job.preprocess_started_at, models.Job.preprocess_finished_at),
+    'inference_wait': (models.Job.preprocess_finished_at, models.Job.inference_started_at),
+    'inference': (models.Job.inference_started_at, models.Job.inference_finished_at),
+    'postprocess_wait': (models.Job.inference_finished_at, models.Job.postprocess_started_at),
+    'postprocess': (models.Job.postprocess_started_at, models.Job.postprocess_finished_at),
+    'total': (models.Job.created_at, models.Job.postprocess_finished_at),
+}
+PERCENTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
 
 models.Base.metadata.create_all(bind=engine)
 
@@ -39,9 +80,14 @@ def index(request: Request):
     return templates.TemplateResponse('index.html', {'request': request})
 
 
-@app.get('/models/', response_model=list[schemas.Model])
-def list_models(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return db.query(models.Model).offset(skip).limit(limit).all()
+@app.get('/models/', response_model=list[schemas.Model], dependencies=[Depends(reject_skip)])
+def list_models(
+    response: Response,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=MAX_LIMIT),
+    db: Session = Depends(get_db),
+):
+    return paginate(db.query(models.Model), models.Model, cursor, limit, response)
 
 
 @app.get('/models/{model_id}', response_model=schemas.Model)
@@ -52,6 +98,42 @@ def read_model(model_id: int, db: Session = Depends(get_db)):
     return db_model
 
 
+@app.get('/models/{model_id}/timings', response_model=schemas.ModelTimings)
+def read_model_timings(
+    model_id: int,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    cold_start: bool | None = None,
+    db: Session = Depends(get_db),
+):
+    # Completed jobs created in the window, the last day unless given
+    since = since or datetime.now(timezone.utc) - timedelta(days=1)
+    columns = []
+    for start, end in TIMINGS.values():
+        seconds = extract('epoch', end - start)
+        columns.append(func.avg(seconds))
+        columns.extend(func.percentile_cont(q).within_group(seconds) for q in PERCENTILES.values())
+        columns.append(func.max(seconds))
+
+    query = db.query(func.count(), func.count().filter(models.Job.cold_start), *columns).filter(
+        models.Job.model_id == model_id,
+        models.Job.status == models.JobStatus.COMPLETED,
+        models.Job.created_at >= since,
+    )
+    if until is not None:
+        query = query.filter(models.Job.created_at < until)
+    if cold_start is not None:
+        query = query.filter(models.Job.cold_start == cold_start)
+    jobs, cold_starts, *values = query.one()
+
+    width = len(PERCENTILES) + 2
+    stages = {}
+    for i, name in enumerate(TIMINGS):
+        mean, *percentiles, maximum = values[i * width:(i + 1) * width]
+        stages[name] = schemas.StageTiming(mean=mean, **dict(zip(PERCENTILES, percentiles)), max=maximum)
+    return schemas.ModelTimings(model_id=model_id, jobs=jobs, cold_starts=cold_starts, stages=stages)
+
+
 @app.post('/models/', response_model=schemas.Model)
 def create_model(name: str, file: UploadFile, db: Session = Depends(get_db)):
     db_model = models.Model(name=name)
@@ -77,36 +159,322 @@ def create_model(name: str, file: UploadFile, db: Session = Depends(get_db)):
     return db_model
 
 
+def record_prediction(model_id: int, data: bytes, result: bytes):
+    # After the response was sent, so recorded predictions are as fast as unrecorded ones
+    db = SessionLocal()
+    try:
+        argument_path = f'uploads/predict-{uuid.uuid4().hex}'
+        object_storage.put_object(argument_path, io.BytesIO(data))
+        db_job = models.Job(model_id=model_id, argument_path=argument_path, status=models.JobStatus.COMPLETED)
+        db.add(db_job)
+        db.commit()
+
+        result_path = f'results/{db_job.id}'
+        object_storage.put_object(result_path, io.BytesIO(result))
+        db_job.result_path = result_path
+        db.commit()
+    finally:
+        db.close()
+
+
+def run_prediction(model_id: int, data: bytes) -> bytes:
+    result = tasks.predict.apply_async(
+        (model_id, base64.b64encode(data).decode()),
+        queue=routing.route(model_id),
+    )
+    try:
+        return base64.b64decode(result.get(timeout=PREDICT_TIMEOUT))
+    except CeleryTimeoutError:
+        raise HTTPException(status_code=504, detail='Prediction timed out')
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post('/models/{model_id}/predict')
+async def predict(model_id: int, request: Request, background_tasks: BackgroundTasks, record: bool = False):
+    # The request body is the input file, the response body the result file
+    data = await request.body()
+    if len(data) > PREDICT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f'Inputs over {PREDICT_MAX_BYTES} bytes need a job')
+
+    result = await run_in_threadpool(run_prediction, model_id, data)
+    if record:
+        background_tasks.add_task(record_prediction, model_id, data, result)
+    return Response(result, media_type='application/octet-stream')
+
+
 @app.post('/jobs/', response_model=schemas.Job)
 def create_job(job: schemas.JobCreate, db: Session = Depends(get_db)):
-    db_job = models.Job(**job.dict())
+    db_job = models.Job(**job.dict(), cache_key=result_cache.job_key(db, job.model_id, job.argument_path))
+    result_path = result_cache.lookup(db_job.cache_key)
+    if result_path is not None:
+        # The same input went through the same model version before
+        db_job.status = models.JobStatus.COMPLETED
+        db_job.result_path = result_path
     db.add(db_job)
     db.commit()
-    tasks.preprocess.delay(db_job.id)
+    if result_path is None:
+        # Prefer workers that have the model loaded already
+        tasks.preprocess.apply_async((db_job.id,), queue=routing.route(db_job.model_id))
     db.refresh(db_job)
     return db_job
 
 
+@app.post('/jobs/batch', response_model=schemas.JobBatchCreated)
+def create_jobs(batch: schemas.JobBatchCreate, db: Session = Depends(get_db)):
+    if len(batch.jobs) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f'At most {MAX_BATCH_SIZE} jobs per batch')
+    batch_id = batch.batch_id or uuid.uuid4().hex
+
+    # A single multi-row INSERT ... RETURNING for the whole batch
+    rows = [{**job.dict(), 'batch_id': batch_id} for job in batch.jobs]
+    job_ids = list(db.scalars(insert(models.Job).returning(models.Job.id, sort_by_parameter_order=True), rows))
+    db.commit()
+
+    queues = {model_id: routing.route(model_id) for model_id in {job.model_id for job in batch.jobs}}
+    jobs = list(zip(job_ids, batch.jobs))
+    for start in range(0, len(jobs), PUBLISH_CHUNK_SIZE):
+        # One broker connection per chunk instead of one per job
+        with tasks.app.producer_or_acquire() as producer:
+            for job_id, job in jobs[start:start + PUBLISH_CHUNK_SIZE]:
+                tasks.preprocess.apply_async((job_id,), queue=queues[job.model_id], producer=producer)
+
+    return schemas.JobBatchCreated(batch_id=batch_id, job_ids=job_ids)
+
+
+@app.get('/batches/{batch_id}', response_model=schemas.Batch)
+def read_batch(batch_id: str, db: Session = Depends(get_db)):
+    statuses = dict(
+        db.query(models.Job.status, func.count())
+        .filter(models.Job.batch_id == batch_id)
+        .group_by(models.Job.status)
+        .all()
+    )
+    if not statuses:
+        raise HTTPException(status_code=404, detail='Batch not found')
+    return schemas.Batch(
+        batch_id=batch_id,
+        total=sum(statuses.values()),
+        finished=sum(count for status, count in statuses.items() if status in events.FINISHED),
+        statuses=statuses,
+    )
+
+
+class BacklogCollector:
+    """Broker queue lengths and jobs by status, read on every scrape"""
+
+    def collect(self):
+        if routing.client is not None:
+            lengths = GaugeMetricFamily('ais_queue_length', 'Tasks waiting in a broker queue', labels=['queue'])
+            queues = {routing.DEFAULT_QUEUE}
+            for key in routing.client.scan_iter(match=routing.RESIDENTS_KEY.format(queue='*')):
+                queues.add(key.decode().split(':', 2)[2])
+            for queue in sorted(queues):
+                lengths.add_metric([queue], routing.queue_length(queue))
+            yield lengths
+
+        jobs = GaugeMetricFamily('ais_jobs', 'Jobs by status', labels=['status'])
+        db = SessionLocal()
+        try:
+            counts = dict(db.query(models.Job.status, func.count()).group_by(models.Job.status).all())
+        finally:
+            db.close()
+        for status in models.JobStatus:
+            jobs.add_metric([status.value], counts.get(status, 0))
+        yield jobs
+
+
+metrics.register(BacklogCollector())
+
+
+@app.get('/metrics')
+def read_metrics():
+    data, content_type = metrics.latest()
+    return Response(data, headers={'Content-Type': content_type})
+
+
+@app.get('/cache/stats', response_model=schemas.CacheStats)
+def read_cache_stats():
+    return result_cache.stats()
+
+
+def get_job(job_id: int) -> models.Job | None:
+    db = SessionLocal()
+    try:
+        return db.query(models.Job).filter(models.Job.id == job_id).first()
+    finally:
+        db.close()
+
+
+def get_jobs(job_ids) -> list[models.Job]:
+    db = SessionLocal()
+    try:
+        return db.query(models.Job).filter(models.Job.id.in_(job_ids)).all()
+    finally:
+        db.close()
+
+
+def job_snapshot(job: models.Job) -> dict:
+    return schemas.Job.model_validate(job, from_attributes=True).model_dump(mode='json')
+
+
+async def missed_events(statuses: dict) -> list[dict]:
+    # The jobs not finished whose status differs from the one last sent, as read from the database
+    job_ids = [job_id for job_id, status in statuses.items() if models.JobStatus(status) not in events.FINISHED]
+    if not job_ids:
+        return []
+    jobs = await run_in_threadpool(get_jobs, job_ids)
+    return [job_snapshot(job) for job in jobs if job.status.value != statuses[job.id]]
+
+
+async def next_events(subscription: events.Subscription, statuses: dict) -> list[dict] | None:
+    """Events of the followed jobs, None after KEEPALIVE seconds without any
+
+    statuses holds the status last sent of each job. Events lost while the hub
+    reconnected, and ones of a hub that never received them, are read from the jobs on
+    RESYNC and on every timeout.
+    """
+    try:
+        event = await subscription.get(KEEPALIVE)
+    except asyncio.TimeoutError:
+        event = None
+    if event is not None and event is not events.RESYNC:
+        return [event]
+
+    missed = await missed_events(statuses)
+    return missed if missed or event is events.RESYNC else None
+
+
+@app.get('/jobs/events')
+async def stream_jobs(ids: str):
+    """Server-sent events of the given jobs, e.g. ?ids=1,2,3, until all of them finished"""
+    try:
+        job_ids = [int(job_id) for job_id in ids.split(',') if job_id]
+    except ValueError:
+        raise HTTPException(status_code=400, detail='ids must be job ids separated by commas, e.g. ?ids=1,2,3')
+
+    async def stream():
+        # Subscribed before reading the jobs, so no change is missed in between
+        async with events.Subscription(job_ids) as subscription:
+            statuses = {}  # job_id -> status last sent, of the jobs not finished
+            for job in sorted(await run_in_threadpool(get_jobs, job_ids), key=lambda job: job_ids.index(job.id)):
+                yield f'event: status\ndata: {json.dumps(job_snapshot(job))}\n\n'
+                if job.status not in events.FINISHED:
+                    statuses[job.id] = job.status.value
+
+            while statuses:
+                updates = await next_events(subscription, statuses)
+                if updates is None:
+                    yield ': keep-alive\n\n'
+                    continue
+                for event in updates:
+                    # Read from the job already, or finished
+                    if statuses.get(event['id'], event['status']) == event['status']:
+                        continue
+                    yield f'event: status\ndata: {json.dumps(event)}\n\n'
+                    statuses[event['id']] = event['status']
+                    if models.JobStatus(event['status']) in events.FINISHED:
+                        del statuses[event['id']]
+
+    return StreamingResponse(stream(), media_type='text/event-stream')
+
+
+async def follow_jobs(websocket: WebSocket, subscription: events.Subscription):
+    # e.g. {"follow": [1, 2]} or {"unfollow": [1]}
+    try:
+        while True:
+            message = await websocket.receive_json()
+            subscription.unfollow(message.get('unfollow', []))
+            job_ids = message.get('follow', [])
+            subscription.follow(job_ids)
+            for job_id in job_ids:
+                job = await run_in_threadpool(get_job, job_id)
+                if job is not None:
+                    subscription.queue.put_nowait(job_snapshot(job))
+    except WebSocketDisconnect:
+        pass
+
+
+@app.websocket('/jobs/ws')
+async def watch_jobs(websocket: WebSocket):
+    await websocket.accept()
+    async with events.Subscription() as subscription:
+        receiver = asyncio.create_task(follow_jobs(websocket, subscription))
+        statuses = {}  # job_id -> status last sent
+        try:
+            while not receiver.done():
+                for job_id in set(statuses) - subscription.job_ids:
+                    del statuses[job_id]
+                for event in await next_events(subscription, statuses) or ():
+                    statuses[event['id']] = event['status']
+                    await websocket.send_json(event)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            receiver.cancel()
+
+
 @app.get('/jobs/{job_id}', response_model=schemas.Job)
-def read_job(job_id: str, db: Session = Depends(get_db)):
-    db_job = db.query(models.Job).filter(models.Job.id == job_id).first()
-    if db_job is None:
-        raise HTTPException(status_code=404, detail='Job not found')
-    return db_job
+async def read_job(job_id: int, wait: float = 0):
+    # With ?wait=, answers once the job changes or after that many seconds
+    async with events.Subscription([job_id] if wait > 0 else []) as subscription:
+        db_job = await run_in_threadpool(get_job, job_id)
+        if db_job is None:
+            raise HTTPException(status_code=404, detail='Job not found')
+        if wait <= 0 or db_job.status in events.FINISHED:
+            return db_job
+
+        deadline = asyncio.get_running_loop().time() + min(wait, MAX_WAIT)
+        while True:
+            try:
+                event = await subscription.get(max(0, deadline - asyncio.get_running_loop().time()))
+            except asyncio.TimeoutError:
+                return db_job
+            job = await run_in_threadpool(get_job, job_id)
+            # Resubscribed, the job may have changed meanwhile
+            if event is not events.RESYNC or job.status != db_job.status:
+                return job
 
 
-@app.get('/jobs/', response_model=list[schemas.Job])
-def read_jobs(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return db.query(models.Job).offset(skip).limit(limit).all()
+@app.get('/jobs/', response_model=list[schemas.Job], dependencies=[Depends(reject_skip)])
+def read_jobs(
+    response: Response,
+    model_id: int | None = None,
+    status: list[models.JobStatus] = Query([]),
+    batch_id: str | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=MAX_LIMIT),
+    db: Session = Depends(get_db),
+):
+    query = db.query(models.Job)
+    if model_id is not None:
+        query = query.filter(models.Job.model_id == model_id)
+    if status:
+        query = query.filter(models.Job.status.in_(status))
+    if batch_id is not None:
+        query = query.filter(models.Job.batch_id == batch_id)
+    if created_after is not None:
+        query = query.filter(models.Job.created_at >= created_after)
+    if created_before is not None:
+        query = query.filter(models.Job.created_at < created_before)
+    return paginate(query, models.Job, cursor, limit, response)
 
 
 @app.post('/files/')
 def upload_file(file: UploadFile) -> schemas.FileCreated:
     try:
         object_path = f'uploads/{file.filename}'
+        # Kept with the object, so jobs with the same input can share results
+        sha256 = hashlib.sha256()
+        while chunk := file.file.read(1024 * 1024):
+            sha256.update(chunk)
+        file.file.seek(0)
         object_storage.put_object(
             object_path,
             file.file,
+            metadata={result_cache.DIGEST_METADATA: sha256.hexdigest()},
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
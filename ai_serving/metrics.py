@@ -0,0 +1,86 @@
+import os
+
+import prometheus_client
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from .procfs import process_cpu, session_pids
+
+# Workers serve their metrics on this port, pool processes on the following ones. 0 turns it off
+WORKER_PORT = int(os.getenv('AIS_METRICS_PORT', 9100))
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LOAD_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+SIZE_BUCKETS = tuple(4 ** i for i in range(4, 16))  # 256 B to 1 GiB
+
+# Stages are queue_wait, preprocess, inference, postprocess and predict
+stage_seconds = prometheus_client.Histogram(
+    'ais_stage_seconds', 'Time jobs spend in each stage', ['model', 'stage'], buckets=LATENCY_BUCKETS
+)
+storage_seconds = prometheus_client.Histogram(
+    'ais_object_storage_seconds', 'Duration of object storage requests', ['operation'],
+    buckets=LATENCY_BUCKETS,
+)
+# Kinds are input and result files
+payload_bytes = prometheus_client.Histogram(
+    'ais_payload_bytes', 'Size of job inputs and results', ['model', 'kind'], buckets=SIZE_BUCKETS
+)
+model_load_seconds = prometheus_client.Histogram(
+    'ais_model_load_seconds', 'Time to load a model that was not resident', ['model'],
+    buckets=LOAD_BUCKETS,
+)
+
+
+class ModelCollector:
+    """Resource use of the models resident in this worker process, read on every scrape"""
+
+    def __init__(self, model_workers):
+        self.model_workers = model_workers
+
+    def collect(self):
+        memory = GaugeMetricFamily('ais_model_memory_bytes', 'Memory used by a model', labels=['model'])
+        cpu = CounterMetricFamily('ais_model_cpu_seconds', 'CPU time of the processes of a model', labels=['model'])
+        replicas = GaugeMetricFamily('ais_model_replicas', 'Replicas serving a model', labels=['model'])
+        inflight = GaugeMetricFamily('ais_model_inflight', 'Requests a model is working on', labels=['model'])
+
+        with self.model_workers.lock:
+            resident = list(self.model_workers.model_workers.values())
+        for model_worker in resident:
+            model_id = str(model_worker.model.id)
+            # ONNX models run inside this process
+            process = getattr(model_worker, 'process', None)
+            pids = session_pids(process.pid) if process is not None else [os.getpid()]
+            try:
+                memory.add_metric([model_id], model_worker.memory())
+            except OSError:
+                pass
+            cpu.add_metric([model_id], sum(process_cpu(pid) for pid in pids))
+            replicas.add_metric([model_id], model_worker.replicas)
+            inflight.add_metric([model_id], model_worker.inflight)
+
+        yield from (memory, cpu, replicas, inflight)
+
+
+def register(collector):
+    try:
+        prometheus_client.REGISTRY.register(collector)
+    except ValueError as e:
+        # Registered already, e.g. by the process this one was forked from
+        print(f'Skipped registering {type(collector).__name__}: {e}')
+
+
+def serve(offset: int = 0):
+    # Every worker process has metrics of its own
+    if not WORKER_PORT:
+        return
+    port = WORKER_PORT + offset
+    try:
+        prometheus_client.start_http_server(port)
+    except OSError as e:
+        print(f'Failed to serve metrics on port {port}: {e!r}')
+        return
+    print(f'Serving metrics on port {port}')
+
+
+def latest() -> tuple[bytes, str]:
+    return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
@@ -1,18 +1,114 @@
+import fcntl
+import hashlib
+import itertools
+import json
 import os
+import platform
+import select
+import shlex
 import shutil
-import socket
+import signal
 import stat
 import subprocess
 import tempfile
+import threading
 import time
 import venv
 
+from concurrent.futures import Future
+
 import appdirs
 import numpy as np
 
-from . import models, object_storage
+from . import artifacts, cpu_manager, metrics, models, object_storage
+from .batching import Batcher
+from .procfs import process_memory, session_pids
+from .rpc import Connection
 from .worker_templates import common
 
+CACHE_DIR = appdirs.user_cache_dir('ais_')
+# Prebuilt wheels shared by every model environment
+WHEEL_DIR = os.path.join(CACHE_DIR, 'wheels')
+# Files that decide what a model environment contains
+ENV_FILES = ('setup', 'requirements.txt')
+# Marks a completely built environment
+ENV_READY = '.ais-ready'
+# Holds the ETag of the archive unpacked in a model directory
+ARTIFACT_MARKER = '.ais-artifact'
+# Per worker process directories of the sockets and shm segments of a model
+RUNTIME_DIR_NAME = 'run'
+
+# Shared memory segments older than this belong to crashed stages
+SHM_MAX_AGE = int(os.getenv('AIS_SHM_MAX_AGE', 3600))
+# Seconds a model may take to load() before it is considered failed
+LOAD_TIMEOUT = float(os.getenv('AIS_LOAD_TIMEOUT', 600))
+# Seconds between health pings, and how long a ping may take
+HEALTH_INTERVAL = float(os.getenv('AIS_HEALTH_INTERVAL', 5))
+HEALTH_TIMEOUT = float(os.getenv('AIS_HEALTH_TIMEOUT', 10))
+# Consecutive failed pings before the model process is restarted
+HEALTH_FAILURES = int(os.getenv('AIS_HEALTH_FAILURES', 3))
+# Upper bound of the backoff between restarts of a crashing model
+MAX_RESTART_DELAY = float(os.getenv('AIS_MAX_RESTART_DELAY', 60))
+
+
+class ModelBusyError(RuntimeError):
+    """The model subprocess has too many pending requests, retry later"""
+
+
+def model_venv_dir(model: models.Model) -> str:
+    return os.path.join(
+        CACHE_DIR,
+        'venvs',
+        f'model_{model.id}',
+    )
+
+
+def unpack_model_files(model: models.Model) -> str:
+    venv_dir = model_venv_dir(model)
+    model_dir = os.path.join(venv_dir, 'model')
+    os.makedirs(venv_dir, exist_ok=True)
+
+    # Extract model files to venv/model, unless this version already is
+    archive_path, etag = artifacts.fetch(model.module_path)
+    artifact_path = os.path.join(venv_dir, ARTIFACT_MARKER)
+
+    # Other worker processes may be loading the same model
+    with open(os.path.join(venv_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if os.path.isdir(model_dir) and os.path.exists(artifact_path):
+            with open(artifact_path, 'r') as f:
+                unpacked = f.read() == etag
+        else:
+            unpacked = False
+
+        if unpacked:
+            print(f'Model {model.id} files are up to date')
+        else:
+            unpack_dir = f'{model_dir}.unpack'
+            shutil.rmtree(unpack_dir, ignore_errors=True)
+            shutil.unpack_archive(archive_path, unpack_dir)
+            shutil.rmtree(model_dir, ignore_errors=True)
+            os.rename(unpack_dir, model_dir)
+            with open(artifact_path, 'w') as f:
+                f.write(etag)
+
+    return model_dir
+
+
+def sweep_runtime_dirs(venv_dir: str):
+    # Remove the sockets and segments of worker processes that are gone
+    run_dir = os.path.join(venv_dir, RUNTIME_DIR_NAME)
+    if not os.path.isdir(run_dir):
+        return
+    for entry in os.scandir(run_dir):
+        try:
+            os.kill(int(entry.name), 0)
+        except ProcessLookupError:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        except (ValueError, PermissionError):
+            pass
+
 
 class ModelWorker:
 
@@ -22,158 +118,486 @@ class ModelWorker:
         self.setup()
 
     def setup(self):
+        self.inflight = 0
+        self.last_used = time.time()
+        self.usage_lock = threading.Lock()
+
         self.install_model_files()
-        self.start_model_worker()
+        self.config = common.load_config(self.model_dir)
+        # 'socket' sends array data over ais.sock, 'shm' only sends segment descriptors
+        self.transport = self.config.get('transport', 'socket')
+        self.flags = common.FLAG_SHM if self.transport == 'shm' else 0
+        # 'staged' runs each stage as its own task, 'fused' runs all of them in one worker
+        self.pipeline = self.config.get('pipeline', 'staged')
+        self.pipeline_depth = self.config.get('pipeline_depth', 2)
+        # Serving processes forked by the model process after load(), scaled up to max_replicas
+        server_config = self.config.get('server', {})
+        self.initial_replicas = server_config.get('replicas', 1)
+        self.max_replicas = server_config.get('max_replicas', self.initial_replicas)
+        self.replicas = self.initial_replicas
+        # Requests are multiplexed over a few long-lived connections to each of them
+        self.connections: list[Connection | None] = [None] * self.config.get('connections', 2) * self.max_replicas
+        self.control: Connection | None = None
+        self.connection_counter = itertools.count()
+        self.connections_lock = threading.Lock()
+        # Set while the model process is loaded and serving
+        self.ready = threading.Event()
+        self.failure = None
+        self.stopping = threading.Event()
+        # Set by calls that lost their connection, the supervisor checks the model right away
+        self.suspect = threading.Event()
+        try:
+            self.start_model_worker()
+        except Exception:
+            cpu_manager.release(self)
+            raise
+        self.connection()
+        self.batcher = self.create_batcher()
+
+        self.supervisor = threading.Thread(target=self.supervise, daemon=True)
+        self.supervisor.start()
+
+        self.warmup()
+
+    def warmup(self):
+        # e.g. {"input": "samples/digit.png", "runs": 2}, a path inside the model archive
+        warmup = self.config.get('warmup')
+        if not warmup:
+            return
+        if isinstance(warmup, str):
+            warmup = {'input': warmup}
+
+        started = time.time()
+        try:
+            for _ in range(warmup.get('runs', 1)):
+                outputs = self.inference(self.preprocess_file(os.path.join(self.model_dir, warmup['input'])))
+                common.release_shm(outputs)
+        except Exception as e:
+            # A model that serves but fails to warm up is still usable
+            print(f'Failed to warm up model {self.model.id}: {e!r}')
+            return
+        print(f'Warmed up model {self.model.id} in {time.time() - started:.2f}s')
 
     def install_model_files(self):
-        if not os.path.exists(self.venv_dir):
-            venv.create(self.venv_dir, with_pip=True)
-
-        # Extract model files to venv/model
-        # TODO: Copy from object storage
-        res = object_storage.get_object(self.model.module_path)
-        filename = os.path.basename(self.model.module_path)
-        archive_path = os.path.join(self.venv_dir, filename)
-        with open(archive_path, 'wb') as file:
-            file.write(res.read())
-        shutil.unpack_archive(archive_path, self.model_dir)
+        unpack_model_files(self.model)
+
+        self.env_dir = self.ensure_env()
+
+        # Copy init.py to venv, not while another worker process starts it
+        with open(os.path.join(self.venv_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                shutil.copytree(self.template_dir, self.venv_dir, dirs_exist_ok=True)
+            except FileExistsError:
+                pass
+
+    def env_key(self) -> str:
+        # Models with the same dependencies share one environment
+        digest = hashlib.sha256(platform.python_version().encode())
+        for name in ENV_FILES:
+            path = os.path.join(self.model_dir, name)
+            digest.update(b'\0' + name.encode() + b'\0')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+        return digest.hexdigest()[:16]
+
+    def ensure_env(self) -> str:
+        env_dir = os.path.join(CACHE_DIR, 'envs', self.env_key())
+        os.makedirs(os.path.dirname(env_dir), exist_ok=True)
+
+        # Other workers may be building the same environment
+        with open(f'{env_dir}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            ready_path = os.path.join(env_dir, ENV_READY)
+            if os.path.exists(ready_path):
+                print(f'Model {self.model.id} reuses environment {env_dir}')
+                return env_dir
+
+            # Leftover of an interrupted build
+            shutil.rmtree(env_dir, ignore_errors=True)
+
+            print(f'Building environment {env_dir} for model {self.model.id}')
+            venv.create(env_dir, with_pip=True)
+            self.install_requirements(env_dir)
+
+            open(ready_path, 'w').close()
+
+        return env_dir
+
+    def install_requirements(self, env_dir: str):
+        os.makedirs(WHEEL_DIR, exist_ok=True)
+        requirements = []
 
         setup_path = os.path.join(self.model_dir, 'setup')
+        requirements_path = os.path.join(self.model_dir, 'requirements.txt')
         if os.path.exists(setup_path):
             # Ensure setup script is executable
             current_mode = stat.S_IMODE(os.lstat(setup_path).st_mode)
             os.chmod(setup_path, current_mode | stat.S_IXUSR)
-            # Run setup script inside venv
+            # Run setup script inside venv, pip prefers wheels from the local cache
             print('Running setup script!!!!')
             subprocess.run(
-                ['bash', '-c', '. ../bin/activate && ./setup'],
-                cwd=self.model_dir
+                ['bash', '-c', f'. {shlex.quote(os.path.join(env_dir, "bin", "activate"))} && ./setup'],
+                cwd=self.model_dir,
+                env={**os.environ, 'PIP_FIND_LINKS': WHEEL_DIR},
+                check=True,
             )
-        else:
+        elif os.path.exists(requirements_path):
             # Install model dependencies from venv/model/requirements.txt
-            subprocess.run(
-                [
-                    os.path.join(self.venv_dir, 'bin', 'pip'),
-                    'install',
-                    '-r',
-                    os.path.join(self.model_dir, 'requirements.txt'),
-                ],
-                stdout=subprocess.DEVNULL,
-            )
+            requirements = ['-r', requirements_path]
 
         # Ensure install numpy
+        self.pip_install(env_dir, [*requirements, 'numpy'])
+
+    def pip_install(self, env_dir: str, requirements: list[str]):
+        pip = os.path.join(env_dir, 'bin', 'pip')
+        install = [pip, 'install', '--no-index', '--find-links', WHEEL_DIR, *requirements]
+
+        # Try the local wheel cache alone first, and only fill it from the index when it misses
+        if subprocess.run(install, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            return
         subprocess.run(
-            [
-                os.path.join(self.venv_dir, 'bin', 'pip'),
-                'install',
-                'numpy',
-            ],
+            [pip, 'wheel', '--wheel-dir', WHEEL_DIR, '--find-links', WHEEL_DIR, *requirements],
             stdout=subprocess.DEVNULL,
+            check=True,
         )
+        subprocess.run(install, stdout=subprocess.DEVNULL, check=True)
 
-        # Copy init.py to venv
+    def start_model_worker(self):
+        sweep_runtime_dirs(self.venv_dir)
+        os.makedirs(self.shm_dir, exist_ok=True)
+        common.sweep_shm(self.shm_dir, SHM_MAX_AGE)
+
+        # init.py reports on this pipe whether load() succeeded
+        status_fd, child_status_fd = os.pipe()
         try:
-            shutil.copytree(self.template_dir, self.venv_dir, dirs_exist_ok=True)
-        except FileExistsError:
-            pass
+            self.process = subprocess.Popen(
+                [
+                    os.path.join(self.env_dir, 'bin', 'python'),
+                    os.path.join(self.venv_dir, "init.py")
+                ],
+                cwd=self.venv_dir,
+                # Own process group, so that stop() also reaches processes forked by the model
+                start_new_session=True,
+                pass_fds=(child_status_fd,),
+                env={
+                    **os.environ,
+                    **cpu_manager.thread_env(self),
+                    common.STATUS_FD_ENV: str(child_status_fd),
+                    common.RUNTIME_DIR_ENV: self.runtime_dir,
+                },
+            )
+        finally:
+            os.close(child_status_fd)
 
-    def start_model_worker(self):
+        with os.fdopen(status_fd, 'rb') as status:
+            self.wait_ready(status)
 
-        self.process = subprocess.Popen(
-            [
-                os.path.join(self.venv_dir, 'bin', 'python'),
-                os.path.join(self.venv_dir, "init.py")
-            ],
-            cwd=self.venv_dir,
-        )
+        self.replicas = self.initial_replicas
+        cpu_manager.rebalance()
+        self.failure = None
+        self.ready.set()
 
-    def preprocess(self, argument_path: str) -> bytes:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        local_argument_path = tempfile.mktemp(prefix='ais_')
-        object_storage.fget_object(argument_path, local_argument_path)
+    def wait_ready(self, status):
+        readable, _, _ = select.select([status], [], [], LOAD_TIMEOUT)
+        if not readable:
+            self.kill_process()
+            raise RuntimeError(f'Model {self.model.id} did not load within {LOAD_TIMEOUT} seconds')
 
-        for i in range(3):
-            try:
-                sock.connect(self.socket_path)
-            except (ConnectionRefusedError, FileNotFoundError):
-                delay = 2 ** i
-                print(f'Connection refused, retrying in {delay}')
-                time.sleep(delay)
-            else:
-                break
+        if status.readline() == common.STATUS_READY:
+            return
 
-        msg = common.CMD_PREPROCESS + common.SEPARATOR + local_argument_path.encode()
+        # Either the traceback of load() or nothing when the process died
+        error = status.read().decode()
+        self.kill_process()
+        raise RuntimeError(error or f'Model {self.model.id} exited with code {self.process.returncode}')
 
-        # TODO: Handle large files
+    def kill_process(self):
         try:
-            sock.sendall(msg)
-            resp, arg = sock.recv(1000000).split(common.SEPARATOR, 1)
-        except Exception as e:
-            error_path = os.path.join(self.venv_dir, 'error.txt')
-            if os.path.exists(error_path):
-                # Check error.txt
-                with open(os.path.join(self.venv_dir, 'error.txt'), 'r') as f:
-                    error = f.read()
-                raise RuntimeError(error)
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+    def supervise(self):
+        failures = 0
+        while not self.stopping.is_set():
+            suspected = self.suspect.wait(HEALTH_INTERVAL)
+            self.suspect.clear()
+            if self.stopping.is_set():
+                return
+            if self.process.poll() is not None:
+                print(f'Model {self.model.id} exited with code {self.process.returncode}')
+                self.restart()
+                failures = 0
+                continue
+
+            try:
+                self.connection().submit(common.CMD_PING).result(timeout=HEALTH_TIMEOUT)
+            except Exception as e:
+                failures += 1
+                print(f'Model {self.model.id} failed health check ({failures}/{HEALTH_FAILURES}): {e!r}')
+                # A call lost its connection as well, the process is not serving
+                if suspected or failures >= HEALTH_FAILURES:
+                    self.restart()
+                    failures = 0
             else:
-                raise e
+                failures = 0
+                # Calls that lost their connection to a process still serving go on
+                self.ready.set()
+
+    def restart(self):
+        self.ready.clear()
+        self.kill_process()
+        self.close_connections()
+
+        delay = 1
+        while not self.stopping.is_set():
+            print(f'Restarting model {self.model.id}')
+            try:
+                self.start_model_worker()
+                return
+            except Exception as e:
+                self.failure = str(e)
+                print(f'Model {self.model.id} failed to restart, retrying in {delay}: {e}')
+            self.stopping.wait(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+
+    def wait_until_ready(self):
+        if not self.ready.wait(LOAD_TIMEOUT):
+            raise RuntimeError(self.failure or f'Model {self.model.id} is not ready')
+
+    def negotiate_codec(self, connection: Connection) -> str:
+        # A codec or a list of them in order of preference, e.g. ["fp16+zstd", "zlib"]
+        candidates = self.config.get('codec', common.RawCodec.name)
+        if isinstance(candidates, str):
+            candidates = [candidates]
+        candidates = [spec for spec in candidates if common.supports_codec(spec)]
+
+        _, arg = connection.request(common.CMD_HELLO, json.dumps({'codecs': candidates}).encode())
+        return arg.decode()
+
+    def connect(self, index: int) -> Connection:
+        # The socket is listening once the model reported ready
+        if self.max_replicas > 1:
+            connection = Connection(self.replica_socket_path(index % self.max_replicas))
+        else:
+            connection = Connection(self.socket_path)
+
+        # Codecs are negotiated per connection
+        self.codec = self.negotiate_codec(connection)
+        print(f'Model {self.model.id} uses codec {self.codec}')
+        return connection
+
+    def connection(self) -> Connection:
+        with self.connections_lock:
+            while True:
+                index = next(self.connection_counter) % len(self.connections)
+                # Only replicas that are running
+                if index % self.max_replicas < self.replicas:
+                    break
+            if self.connections[index] is None or self.connections[index].closed:
+                self.connections[index] = self.connect(index)
+            return self.connections[index]
+
+    def close_connections(self):
+        with self.connections_lock:
+            for index, connection in enumerate(self.connections):
+                if connection is not None:
+                    connection.close()
+                self.connections[index] = None
+            if self.control is not None:
+                self.control.close()
+                self.control = None
+
+    def scale(self, replicas: int) -> int:
+        # The parent of the replicas listens on ais.sock
+        replicas = max(1, min(replicas, self.max_replicas))
+        if replicas == self.replicas:
+            return replicas
+
+        if replicas < self.replicas:
+            with self.connections_lock:
+                self.replicas = replicas
+                retired = [
+                    (index, connection) for index, connection in enumerate(self.connections)
+                    if connection is not None and index % self.max_replicas >= replicas
+                ]
+            # Let requests already sent to the retired replicas finish
+            deadline = time.monotonic() + HEALTH_TIMEOUT
+            while any(connection.pending for _, connection in retired) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            with self.connections_lock:
+                for index, connection in retired:
+                    connection.close()
+                    if self.connections[index] is connection:
+                        self.connections[index] = None
+
+        self.wait_until_ready()
+        with self.connections_lock:
+            if self.control is None or self.control.closed:
+                self.control = Connection(self.socket_path)
+            control = self.control
+        resp, arg = control.request(common.CMD_SCALE, json.dumps({'replicas': replicas}).encode())
+        if resp != common.RESP_OK:
+            raise RuntimeError(arg.decode())
+        self.replicas = json.loads(arg)['replicas']
+        print(f'Model {self.model.id} runs {self.replicas} replicas')
+        cpu_manager.rebalance()
+        return self.replicas
+
+    def create_batcher(self) -> Batcher | None:
+        # e.g. {"max_batch_size": 8, "max_wait_ms": 5, "padding": "none"}
+        options = self.config.get('batching')
+        if not options or options.get('max_batch_size', 1) <= 1:
+            return None
+        return Batcher(self.infer_arrays, **options)
+
+    @property
+    def max_batch_size(self) -> int:
+        return self.batcher.max_batch_size if self.batcher else 1
+
+    def encode(self, arrays: list[np.ndarray]) -> bytes:
+        if self.transport == 'shm':
+            return common.ndarraylist_to_shm(arrays, self.shm_dir)
+        return common.ndarraylist_to_bytes(arrays, self.codec)
+
+    def track(self):
+        # Models with requests in flight are never evicted
+        with self.usage_lock:
+            self.inflight += 1
+            self.last_used = time.time()
+
+    def untrack(self):
+        with self.usage_lock:
+            self.inflight -= 1
+            self.last_used = time.time()
+
+    def request(self, command: bytes, *buffers, flags: int = 0) -> bytearray:
+        self.track()
+        try:
+            return self.call(command, *buffers, flags=flags)
+        finally:
+            self.untrack()
 
-        os.unlink(local_argument_path)
+    def call(self, command: bytes, *buffers, flags: int = 0) -> bytearray:
+        self.wait_until_ready()
+        process = self.process
+        try:
+            resp, arg = self.connection().request(command, *buffers, flags=flags)
+        except OSError:
+            if process is self.process:
+                # The model process may be dying, even if it did not exit yet. Try once more
+                # when the supervisor found it serving or restarted it
+                self.ready.clear()
+                self.suspect.set()
+            self.wait_until_ready()
+            resp, arg = self.connection().request(command, *buffers, flags=flags)
 
         if resp == common.RESP_ERR:
             raise RuntimeError(arg.decode())
+        if resp == common.RESP_BUSY:
+            state = json.loads(arg)
+            raise ModelBusyError(f'Model {self.model.id} is busy: {state["pending"]}/{state["max_pending"]} pending')
 
         return arg
 
-    def inference(self, encoded_inputs: bytes) -> bytes:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        for i in range(3):
-            try:
-                sock.connect(self.socket_path)
-            except ConnectionRefusedError:
-                delay = 2 ** i
-                print(f'Connection refused, retrying in {delay}')
-                time.sleep(delay)
-            else:
-                break
+    def preprocess(self, argument_path: str) -> bytes:
+        local_argument_path = tempfile.mktemp(prefix='ais_')
+        object_storage.fget_object(argument_path, local_argument_path)
 
-        msg = common.CMD_INFERENCE + common.SEPARATOR + encoded_inputs
+        try:
+            metrics.payload_bytes.labels(self.model.id, 'input').observe(os.path.getsize(local_argument_path))
+            with metrics.stage_seconds.labels(self.model.id, 'preprocess').time():
+                return self.preprocess_file(local_argument_path)
+        finally:
+            os.unlink(local_argument_path)
 
-        sock.sendall(msg)
+    def preprocess_file(self, path: str) -> bytes:
+        return bytes(self.request(common.CMD_PREPROCESS, path.encode(), flags=self.flags))
 
-        resp, arg = sock.recv(10000).split(common.SEPARATOR, 1)
-        if resp == common.RESP_ERR:
-            raise RuntimeError(arg.decode())
+    def inference(self, encoded_inputs: bytes) -> bytes:
+        with metrics.stage_seconds.labels(self.model.id, 'inference').time():
+            return self.submit_inference(encoded_inputs).result()
 
-        return arg
+    def submit_inference(self, encoded_inputs: bytes) -> Future:
+        future = Future()
 
-    def postprocess(self, job: models.Job, encoded_outputs: bytes) -> str:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        for i in range(3):
+        if self.batcher is None:
             try:
-                sock.connect(self.socket_path)
-            except ConnectionRefusedError:
-                delay = 2 ** i
-                print(f'Connection refused, retrying in {delay}')
-                time.sleep(delay)
-            else:
-                break
-
-        msg = common.CMD_POSTPROCESS + common.SEPARATOR + encoded_outputs
-
-        sock.sendall(msg)
+                future.set_result(bytes(self.request(common.CMD_INFERENCE, encoded_inputs, flags=self.flags)))
+            except Exception as e:
+                future.set_exception(e)
+            if not isinstance(future.exception(), ModelBusyError):
+                common.release_shm(encoded_inputs)
+            return future
+
+        def done(batched: Future):
+            # Busy calls are retried later with the same inputs
+            if not isinstance(batched.exception(), ModelBusyError):
+                common.release_shm(encoded_inputs)
+            try:
+                future.set_result(self.encode(batched.result()))
+            except Exception as e:
+                future.set_exception(e)
 
-        resp, arg = sock.recv(10000).split(common.SEPARATOR, 1)
-        if resp == common.RESP_ERR:
-            raise RuntimeError(arg.decode())
+        self.batcher.submit(common.bytes_to_ndarraylist(encoded_inputs)).add_done_callback(done)
+        return future
 
-        result_local_path = arg.decode()
-        result_object_path = f'results/{job.id}'
+    def infer_arrays(self, inputs: list[np.ndarray]) -> list[np.ndarray]:
+        arg = self.encode(inputs)
+        try:
+            outputs = self.request(common.CMD_INFERENCE, arg, flags=self.flags)
+        finally:
+            common.release_shm(arg)
+        arrays = common.bytes_to_ndarraylist(outputs)
+        # Mapped arrays stay valid after the segment is unlinked
+        common.release_shm(outputs)
+        return arrays
+
+    def postprocess(self, job_id: int, encoded_outputs: bytes) -> str:
+        with metrics.stage_seconds.labels(self.model.id, 'postprocess').time():
+            result_local_path = self.postprocess_file(encoded_outputs)
+        metrics.payload_bytes.labels(self.model.id, 'result').observe(os.path.getsize(result_local_path))
+        result_object_path = f'results/{job_id}'
         object_storage.fput_object(result_object_path, result_local_path)
         os.unlink(result_local_path)
 
         return result_object_path
 
+    def postprocess_file(self, encoded_outputs: bytes) -> str:
+        try:
+            arg = self.request(common.CMD_POSTPROCESS, encoded_outputs, flags=self.flags)
+        except ModelBusyError:
+            # Retried later with the same outputs
+            raise
+        except Exception:
+            common.release_shm(encoded_outputs)
+            raise
+        common.release_shm(encoded_outputs)
+
+        return arg.decode()
+
+    def predict_file(self, path: str) -> bytes:
+        # Every stage at once, the result is returned instead of uploaded
+        inputs = self.preprocess_file(path)
+        try:
+            outputs = self.inference(inputs)
+        finally:
+            common.release_shm(inputs)
+        try:
+            result_path = self.postprocess_file(outputs)
+        finally:
+            common.release_shm(outputs)
+
+        try:
+            with open(result_path, 'rb') as f:
+                return f.read()
+        finally:
+            os.unlink(result_path)
+
     # TODO: Remove this
     def run_job(self, argument_path):
         output_path = tempfile.mkdtemp(prefix='ais_')
@@ -193,18 +617,30 @@ class ModelWorker:
 
         return output_path
 
+    def memory(self) -> int:
+        # Every process of the model, including forked replicas and pools
+        total = 0
+        for pid in session_pids(self.process.pid):
+            try:
+                total += process_memory(pid)
+            except OSError:
+                pass
+        return total
+
     def stop(self):
         print(f'Killing model {self.model.id}')
-        self.process.kill()
-        self.process.terminate()
+        self.stopping.set()
+        self.suspect.set()
+        self.ready.clear()
+        if self.batcher is not None:
+            self.batcher.stop()
+        self.close_connections()
+        self.kill_process()
+        cpu_manager.release(self)
 
     @property
     def venv_dir(self):
-        return os.path.join(
-            appdirs.user_cache_dir('ais_'),
-            'venvs',
-            f'model_{self.model.id}',
-        )
+        return model_venv_dir(self.model)
 
     @property
     def model_dir(self):
@@ -214,12 +650,34 @@ class ModelWorker:
         )
 
     @property
-    def socket_path(self):
+    def runtime_dir(self):
+        # Worker processes preloading the same model each run their own copy of it
         return os.path.join(
             self.venv_dir,
+            RUNTIME_DIR_NAME,
+            str(os.getpid()),
+        )
+
+    @property
+    def shm_dir(self):
+        return os.path.join(
+            self.runtime_dir,
+            common.SHM_DIR_NAME,
+        )
+
+    @property
+    def socket_path(self):
+        return os.path.join(
+            self.runtime_dir,
             common.SOCK_NAME,
         )
 
+    def replica_socket_path(self, index: int) -> str:
+        return os.path.join(
+            self.runtime_dir,
+            common.REPLICA_SOCK_NAME.format(index),
+        )
+
     @property
     def template_dir(self):
         return os.path.join(
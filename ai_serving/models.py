@@ -2,7 +2,7 @@ import enum
 
 from datetime import datetime
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, func, Index
 from sqlalchemy.dialects.postgresql import TIMESTAMP
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -11,10 +11,15 @@ from .database import Base
 
 class Model(Base):
     __tablename__ = 'models'
+    __table_args__ = (
+        Index('ix_models_created_at_id', 'created_at', 'id'),
+    )
 
     id: Mapped[int] = mapped_column(nullable=False, primary_key=True, index=True)
     created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default='now()')
-    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default='now()')
+    updated_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP(timezone=True), nullable=False, server_default='now()', onupdate=func.now()
+    )
 
     name: Mapped[str] = mapped_column(nullable=False, unique=True)
     module_path: Mapped[str] = mapped_column(nullable=False)
@@ -37,16 +42,46 @@ class JobStatus(enum.Enum):
 
 class Job(Base):
     __tablename__ = 'jobs'
+    # Listings are ordered by (created_at, id), after any filters
+    __table_args__ = (
+        Index('ix_jobs_created_at_id', 'created_at', 'id'),
+        Index('ix_jobs_model_id_created_at_id', 'model_id', 'created_at', 'id'),
+        Index('ix_jobs_model_id_status_created_at_id', 'model_id', 'status', 'created_at', 'id'),
+        Index('ix_jobs_status_created_at_id', 'status', 'created_at', 'id'),
+        Index('ix_jobs_batch_id_created_at_id', 'batch_id', 'created_at', 'id'),
+    )
 
     id: Mapped[int] = mapped_column(nullable=False, primary_key=True, index=True)
     created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default='now()')
-    updated_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=False, server_default='now()')
+    updated_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP(timezone=True), nullable=False, server_default='now()', onupdate=func.now()
+    )
 
-    status: Mapped[JobStatus] = mapped_column(default=JobStatus.PENDING, index=True)
-    model_id = mapped_column(ForeignKey(Model.id), index=True)
+    status: Mapped[JobStatus] = mapped_column(default=JobStatus.PENDING)
+    model_id = mapped_column(ForeignKey(Model.id))
     argument_path: Mapped[str] = mapped_column(nullable=False)
     result_path: Mapped[str | None] = mapped_column()
 
     failed_log: Mapped[str | None] = mapped_column()
 
+    # Jobs submitted together through /jobs/batch
+    batch_id: Mapped[str | None] = mapped_column()
+
+    # Model version and SHA-256 of the input, jobs with the same key have the same result
+    cache_key: Mapped[str | None] = mapped_column()
+    # Running job with the same input this one waits for
+    leader_id: Mapped[int | None] = mapped_column(ForeignKey('jobs.id'), index=True)
+
+    # Written along with the status changes of each stage, waits in queues are the gaps between them
+    preprocess_started_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
+    preprocess_finished_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
+    inference_started_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
+    inference_finished_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
+    postprocess_started_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
+    postprocess_finished_at: Mapped[datetime | None] = mapped_column(TIMESTAMP(timezone=True))
+    # Worker of the latest stage
+    worker_host: Mapped[str | None] = mapped_column()
+    # Whether some stage had to wait for the model to load
+    cold_start: Mapped[bool] = mapped_column(default=False, server_default='false')
+
     model: Mapped[Model] = relationship(Model, backref='jobs')
@@ -2,6 +2,8 @@ import os
 
 from minio import Minio
 
+from . import metrics
+
 
 MINIO_HOST = os.getenv('MINIO_HOST', 'localhost:9000')
 MINIO_ACCESS_KEY = os.getenv('MINIO_ACCESS_KEY', 'root')
@@ -21,35 +23,59 @@ if not minio_cli.bucket_exists(MINIO_BUCKET):
     minio_cli.make_bucket(MINIO_BUCKET)
 
 
-def put_object(path, file):
-    return minio_cli.put_object(
-        MINIO_BUCKET,
-        path,
-        file,
-        length=-1,
-        part_size=100_000_000,
-    )
+def put_object(path, file, metadata=None):
+    with metrics.storage_seconds.labels('put').time():
+        return minio_cli.put_object(
+            MINIO_BUCKET,
+            path,
+            file,
+            length=-1,
+            part_size=100_000_000,
+            metadata=metadata,
+        )
 
 
 def fput_object(path, filepath):
-    return minio_cli.fput_object(
-        MINIO_BUCKET,
-        path,
-        filepath,
-        part_size=100_000_000,
-    )
+    with metrics.storage_seconds.labels('put').time():
+        return minio_cli.fput_object(
+            MINIO_BUCKET,
+            path,
+            filepath,
+            part_size=100_000_000,
+        )
+
+
+def get_object(path, offset=0, length=0):
+    # Until the response starts, the caller reads the body
+    with metrics.storage_seconds.labels('open').time():
+        return minio_cli.get_object(
+            MINIO_BUCKET,
+            path,
+            offset=offset,
+            length=length,
+        )
 
 
-def get_object(path):
-    return minio_cli.get_object(
-        MINIO_BUCKET,
-        path,
-    )
+def stat_object(path):
+    with metrics.storage_seconds.labels('stat').time():
+        return minio_cli.stat_object(
+            MINIO_BUCKET,
+            path,
+        )
 
 
 def fget_object(path, filepath):
-    return minio_cli.fget_object(
-        MINIO_BUCKET,
-        path,
-        filepath,
-    )
+    with metrics.storage_seconds.labels('get').time():
+        return minio_cli.fget_object(
+            MINIO_BUCKET,
+            path,
+            filepath,
+        )
+
+
+def remove_object(path):
+    with metrics.storage_seconds.labels('remove').time():
+        return minio_cli.remove_object(
+            MINIO_BUCKET,
+            path,
+        )
@@ -0,0 +1,272 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from concurrent.futures import Future
+
+import numpy as np
+import onnxruntime as ort
+
+from PIL import Image
+
+from . import cpu_manager
+from .model_worker import ModelWorker, unpack_model_files
+from .worker_templates import common
+
+# Graph optimisations are applied once per model version and kept next to the model
+OPTIMIZED_NAME = 'optimized.onnx'
+
+ORT_TYPES = {
+    'tensor(float)': np.float32,
+    'tensor(float16)': np.float16,
+    'tensor(double)': np.float64,
+    'tensor(int8)': np.int8,
+    'tensor(int16)': np.int16,
+    'tensor(int32)': np.int32,
+    'tensor(int64)': np.int64,
+    'tensor(uint8)': np.uint8,
+    'tensor(bool)': np.bool_,
+}
+
+
+def read_input(path: str) -> np.ndarray:
+    # Arrays saved with numpy, anything else is taken for an image
+    with open(path, 'rb') as f:
+        if f.read(6) == b'\x93NUMPY':
+            return np.load(path, allow_pickle=False)
+    with Image.open(path) as image:
+        return np.asarray(image.convert('RGB'))
+
+
+def grayscale(array: np.ndarray) -> np.ndarray:
+    return np.dot(array[..., :3], np.array([0.299, 0.587, 0.114], dtype=np.float32))
+
+
+def resize(array: np.ndarray, size: list[int]) -> np.ndarray:
+    height, width = size
+    if array.ndim == 2:
+        image = Image.fromarray(array.astype(np.float32), mode='F')
+        return np.asarray(image.resize((width, height), Image.BILINEAR))
+    image = Image.fromarray(np.clip(array, 0, 255).astype(np.uint8))
+    return np.asarray(image.resize((width, height), Image.BILINEAR))
+
+
+def normalize(array: np.ndarray, scale: float = 1, mean=0, std=1) -> np.ndarray:
+    array = array.astype(np.float32) / scale
+    return (array - np.asarray(mean, dtype=np.float32)) / np.asarray(std, dtype=np.float32)
+
+
+def softmax(array: np.ndarray, axis: int = -1) -> np.ndarray:
+    exp = np.exp(array - array.max(axis=axis, keepdims=True))
+    return exp / exp.sum(axis=axis, keepdims=True)
+
+
+def argmax(array: np.ndarray, axis: int = -1):
+    return np.argmax(array, axis=axis).tolist()
+
+
+def topk(array: np.ndarray, k: int = 5):
+    rows = array.reshape(-1, array.shape[-1])
+    indices = np.argsort(-rows, axis=-1)[:, :k]
+    result = [
+        [{'label': int(index), 'score': float(row[index])} for index in row_indices]
+        for row, row_indices in zip(rows, indices)
+    ]
+    return result[0] if len(result) == 1 else result
+
+
+# Steps of the "preprocess" list in the onnx section of ais.json, applied to the input file
+PREPROCESS_OPS = {
+    'grayscale': grayscale,
+    'resize': resize,
+    'normalize': normalize,
+    'transpose': lambda array, axes: np.transpose(array, axes),
+    'reshape': lambda array, shape: np.reshape(array, shape),
+    'expand_dims': lambda array, axis=0: np.expand_dims(array, axis),
+    'cast': lambda array, dtype='float32': array.astype(dtype),
+}
+
+# Steps of the "postprocess" list, applied to the first output; the last one gives the result
+POSTPROCESS_OPS = {
+    'softmax': softmax,
+    'argmax': argmax,
+    'topk': topk,
+}
+
+
+def apply(ops: dict, steps: list, value):
+    for step in steps:
+        if isinstance(step, str):
+            step = {'op': step}
+        params = dict(step)
+        name = params.pop('op')
+        if name not in ops:
+            raise ValueError(f'Unknown step: {name}')
+        value = ops[name](value, **params)
+    return value
+
+
+class OnnxModelWorker(ModelWorker):
+    """Serves an ONNX model inside the worker process
+
+    Selected with "type": "onnx" in ais.json. There is no virtualenv, model process or
+    socket: preprocess and postprocess follow the declarative steps of the "onnx"
+    section and inference runs on one onnxruntime session shared by all tasks, e.g.
+
+        {"type": "onnx", "onnx": {
+            "model": "mnist-12.onnx",
+            "preprocess": ["grayscale", {"op": "resize", "size": [28, 28]}, {"op": "reshape", "shape": [1, 1, 28, 28]}],
+            "postprocess": ["argmax"]}}
+    """
+
+    def setup(self):
+        self.inflight = 0
+        self.last_used = time.time()
+        self.usage_lock = threading.Lock()
+
+        unpack_model_files(self.model)
+        self.config = common.load_config(self.model_dir)
+        self.spec = self.config.get('onnx', {})
+        self.pipeline = self.config.get('pipeline', 'staged')
+        self.pipeline_depth = self.config.get('pipeline_depth', 2)
+        # Tensors between stages never leave this process
+        self.transport = 'socket'
+        self.flags = 0
+        self.codec = common.RawCodec.name
+        self.process = None
+        self.replicas = self.max_replicas = 1
+        self.ready = threading.Event()
+        self.failure = None
+        self.stopping = threading.Event()
+        # Output arrays of each thread, by output name and shape
+        self.buffers = threading.local()
+
+        try:
+            self.session = self.create_session()
+        except Exception:
+            cpu_manager.release(self)
+            raise
+        self.inputs = self.session.get_inputs()
+        self.outputs = self.session.get_outputs()
+        self.ready.set()
+
+        self.batcher = self.create_batcher()
+        self.warmup()
+
+    def create_session(self) -> ort.InferenceSession:
+        options = ort.SessionOptions()
+        threads = int(cpu_manager.thread_env(self)['AIS_INTRA_OP_THREADS'])
+        options.intra_op_num_threads = threads
+
+        # Unpacking a new version of the model removes the optimised graph with it
+        optimized_path = os.path.join(self.model_dir, OPTIMIZED_NAME)
+        if os.path.exists(optimized_path):
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            return ort.InferenceSession(optimized_path, options, providers=['CPUExecutionProvider'])
+
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        partial_path = f'{optimized_path}.{os.getpid()}'
+        options.optimized_model_filepath = partial_path
+        session = ort.InferenceSession(
+            os.path.join(self.model_dir, self.spec.get('model', 'model.onnx')),
+            options,
+            providers=['CPUExecutionProvider'],
+        )
+        os.replace(partial_path, optimized_path)
+        return session
+
+    def create_batcher(self):
+        # Grouped calls stack requests along the first dimension of the input
+        if self.inputs and self.inputs[0].shape and isinstance(self.inputs[0].shape[0], int):
+            print(f'Not batching model {self.model.id}, its input has a fixed batch size')
+            return None
+        return super().create_batcher()
+
+    def preprocess_file(self, path: str) -> bytes:
+        self.track()
+        try:
+            array = apply(PREPROCESS_OPS, self.spec.get('preprocess', []), read_input(path))
+            return common.ndarraylist_to_bytes([np.asarray(array, dtype=ORT_TYPES.get(self.inputs[0].type))])
+        finally:
+            self.untrack()
+
+    def submit_inference(self, encoded_inputs: bytes) -> Future:
+        if self.batcher is not None:
+            return super().submit_inference(encoded_inputs)
+
+        future = Future()
+        try:
+            future.set_result(self.encode(self.infer_arrays(common.bytes_to_ndarraylist(encoded_inputs))))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def infer_arrays(self, inputs: list[np.ndarray]) -> list[np.ndarray]:
+        self.track()
+        try:
+            return self.run(inputs)
+        finally:
+            self.untrack()
+
+    def run(self, inputs: list[np.ndarray]) -> list[np.ndarray]:
+        binding = self.session.io_binding()
+        for meta, array in zip(self.inputs, inputs):
+            binding.bind_cpu_input(meta.name, np.ascontiguousarray(array))
+
+        # Outputs of known shape are written straight into arrays kept for the next run. Callers
+        # encode them before they run again, so each thread reuses its own
+        if not hasattr(self.buffers, 'arrays'):
+            self.buffers.arrays = {}
+        batch = inputs[0].shape[0] if inputs and inputs[0].ndim else 1
+        outputs = []
+        for meta in self.outputs:
+            shape = [batch if i == 0 and not isinstance(dim, int) else dim for i, dim in enumerate(meta.shape)]
+            dtype = ORT_TYPES.get(meta.type)
+            if dtype is None or not all(isinstance(dim, int) for dim in shape):
+                binding.bind_output(meta.name)
+                outputs.append(None)
+                continue
+            output = self.buffers.arrays.get((meta.name, tuple(shape)))
+            if output is None:
+                output = self.buffers.arrays[(meta.name, tuple(shape))] = np.empty(shape, dtype=dtype)
+            binding.bind_output(meta.name, 'cpu', 0, dtype, output.shape, output.ctypes.data)
+            outputs.append(output)
+
+        self.session.run_with_iobinding(binding)
+
+        if any(output is None for output in outputs):
+            allocated = binding.copy_outputs_to_cpu()
+            outputs = [output if output is not None else allocated[i] for i, output in enumerate(outputs)]
+        return outputs
+
+    def postprocess_file(self, encoded_outputs: bytes) -> str:
+        self.track()
+        try:
+            outputs = common.bytes_to_ndarraylist(encoded_outputs)
+            result = apply(POSTPROCESS_OPS, self.spec.get('postprocess', []), outputs[0])
+            if isinstance(result, np.ndarray):
+                result = result.tolist()
+        finally:
+            self.untrack()
+
+        with tempfile.NamedTemporaryFile('w', prefix='ais_', suffix='.json', delete=False) as f:
+            json.dump(result, f)
+        return f.name
+
+    def memory(self) -> int:
+        # Shares the worker process, count the weights
+        return os.path.getsize(os.path.join(self.model_dir, OPTIMIZED_NAME))
+
+    def scale(self, replicas: int) -> int:
+        return 1
+
+    def stop(self):
+        print(f'Unloading model {self.model.id}')
+        self.stopping.set()
+        self.ready.clear()
+        if self.batcher is not None:
+            self.batcher.stop()
+        self.session = None
+        cpu_manager.release(self)
@@ -0,0 +1,47 @@
+import base64
+import json
+
+from datetime import datetime
+
+from fastapi import HTTPException, Query as QueryParam, Response
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Query
+
+# Most items a page may hold
+MAX_LIMIT = 1000
+
+
+def encode_cursor(item) -> str:
+    key = json.dumps([item.created_at.isoformat(), item.id])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def reject_skip(skip: str | None = QueryParam(None, include_in_schema=False)):
+    # Offsets were replaced by cursors, unknown parameters would be ignored silently
+    if skip is not None:
+        raise HTTPException(
+            status_code=400, detail='skip is not supported anymore, pass the X-Next-Cursor header of a page as ?cursor='
+        )
+
+
+def paginate(query: Query, table, cursor: str | None, limit: int, response: Response) -> list:
+    """Newest items first, one page after the cursor
+
+    Pages are ordered by (created_at, id) and continue right after the last item of the
+    previous page, so every page is an index range scan however deep it is. The cursor
+    of the next page is sent in the X-Next-Cursor header while there may be more.
+    """
+    if cursor:
+        query = query.filter(tuple_(table.created_at, table.id) < decode_cursor(cursor))
+    items = query.order_by(table.created_at.desc(), table.id.desc()).limit(limit).all()
+    if len(items) == limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(items[-1])
+    return items
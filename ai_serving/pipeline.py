@@ -0,0 +1,192 @@
+import os
+import queue
+import threading
+import time
+import traceback
+
+from concurrent.futures import Future
+from datetime import datetime, timezone
+
+from . import events, metrics, models, result_cache
+from .database import SessionLocal
+from .model_worker import ModelBusyError, ModelWorker
+
+# Seconds before a stage is retried when the model has too many pending requests
+BUSY_RETRY_DELAY = float(os.getenv('AIS_BUSY_RETRY_DELAY', 1))
+# Seconds stopping a pipeline waits for its jobs, the ones left are failed
+STOP_TIMEOUT = float(os.getenv('AIS_PIPELINE_STOP_TIMEOUT', 30))
+
+_STOP = object()
+
+
+class FusedPipeline:
+    """Runs every stage of a model's jobs inside this worker
+
+    Each stage has its own thread connected by bounded queues, so preprocess of job N+1
+    overlaps with inference of job N and postprocess of job N-1. The preprocess task
+    returns once a job is handed over, so jobs are not redelivered when the worker stops.
+    """
+
+    def __init__(self, model_worker: ModelWorker, depth: int = 2):
+        self.model_worker = model_worker
+        self.lock = threading.Lock()
+        self.job_ids = set()  # Submitted and not finished yet
+
+        self.preprocess_queue = queue.Queue(maxsize=depth)
+        self.inference_queue = queue.Queue(maxsize=depth)
+        # Keep enough inference calls in flight to fill a batch
+        self.postprocess_queue = queue.Queue(maxsize=max(depth, model_worker.max_batch_size))
+
+        self.threads = [
+            threading.Thread(
+                target=self.run_stage,
+                args=(self.preprocess_queue, self.preprocess, self.inference_queue),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self.run_stage,
+                args=(self.inference_queue, self.inference, self.postprocess_queue),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=self.run_stage,
+                args=(self.postprocess_queue, self.postprocess, None),
+                daemon=True,
+            ),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, job_id: int, argument_path: str):
+        with self.lock:
+            self.job_ids.add(job_id)
+        # Blocks while the pipeline is full, so the worker stops taking new tasks
+        self.preprocess_queue.put((job_id, argument_path))
+
+    def stop(self, timeout: float = STOP_TIMEOUT):
+        # Let queued jobs finish, the sentinel travels through every stage
+        self.preprocess_queue.put(_STOP)
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+
+        with self.lock:
+            job_ids = sorted(self.job_ids)
+            self.job_ids.clear()
+        if not job_ids:
+            return
+        # Nothing would run them again
+        values = {'status': models.JobStatus.FAILED, 'failed_log': 'Worker stopped before the job finished'}
+        db = SessionLocal()
+        try:
+            for job_id in job_ids:
+                # Unless a stage still finished it meanwhile
+                updated = (
+                    db.query(models.Job)
+                    .filter(models.Job.id == job_id, models.Job.status.notin_(events.FINISHED))
+                    .update(values)
+                )
+                db.commit()
+                if updated:
+                    print(f'Failed job {job_id}, its pipeline stopped')
+                    events.publish(job_id, **values)
+                    result_cache.finish(db, db.query(models.Job).filter(models.Job.id == job_id).one())
+        finally:
+            db.close()
+
+    def run_stage(self, source: queue.Queue, stage, target: queue.Queue | None):
+        db = SessionLocal()
+        try:
+            while True:
+                item = source.get()
+                if item is _STOP:
+                    if target is not None:
+                        target.put(_STOP)
+                    return
+
+                job_id, arg = item
+                with self.lock:
+                    if job_id not in self.job_ids:
+                        # Failed when the pipeline stopped
+                        continue
+                try:
+                    result = self.retry_busy(job_id, stage, db, job_id, arg)
+                except Exception as e:
+                    traceback.print_exc()
+                    db.rollback()
+                    self.update(db, job_id, status=models.JobStatus.FAILED, failed_log=str(e))
+                    self.done(job_id)
+                    continue
+
+                if target is not None:
+                    target.put((job_id, result))
+                else:
+                    self.done(job_id)
+        finally:
+            db.close()
+
+    def done(self, job_id: int):
+        with self.lock:
+            self.job_ids.discard(job_id)
+
+    def retry_busy(self, job_id: int, call, *args):
+        while True:
+            try:
+                return call(*args)
+            except ModelBusyError as e:
+                print(f'{e}, retrying job {job_id} in {BUSY_RETRY_DELAY}')
+                time.sleep(BUSY_RETRY_DELAY)
+
+    def update(self, db, job_id: int, **values):
+        db.query(models.Job).filter(models.Job.id == job_id).update(values)
+        db.commit()
+        events.publish(job_id, **values)
+        if values.get('status') in events.FINISHED:
+            result_cache.finish(db, db.query(models.Job).filter(models.Job.id == job_id).one())
+
+    def preprocess(self, db, job_id: int, argument_path: str) -> bytes:
+        # The task already marked the job as preprocessing
+        print(f'Preprocessing job {job_id}')
+        return self.model_worker.preprocess(argument_path)
+
+    def inference(self, db, job_id: int, inputs: bytes) -> tuple[bytes, Future]:
+        print(f'Inferencing job {job_id}')
+        now = datetime.now(timezone.utc)
+        self.update(
+            db, job_id, status=models.JobStatus.INFERENCING, preprocess_finished_at=now, inference_started_at=now
+        )
+        # Do not wait, so that following jobs can join the same batch
+        return inputs, self.submit_inference(inputs)
+
+    def submit_inference(self, inputs: bytes) -> Future:
+        started = time.perf_counter()
+        latency = metrics.stage_seconds.labels(self.model_worker.model.id, 'inference')
+        future = self.model_worker.submit_inference(inputs)
+        future.add_done_callback(lambda _: latency.observe(time.perf_counter() - started))
+        return future
+
+    def postprocess(self, db, job_id: int, submitted: tuple[bytes, Future]):
+        inputs, outputs = submitted
+        while True:
+            try:
+                encoded_outputs = outputs.result()
+                break
+            except ModelBusyError as e:
+                # Busy calls keep their inputs, submit them again rather than waiting on the failed call
+                print(f'{e}, retrying inference of job {job_id} in {BUSY_RETRY_DELAY}')
+                time.sleep(BUSY_RETRY_DELAY)
+                outputs = self.submit_inference(inputs)
+
+        print(f'Postprocessing job {job_id}')
+        now = datetime.now(timezone.utc)
+        self.update(
+            db, job_id, status=models.JobStatus.POSTPROCESSING, inference_finished_at=now, postprocess_started_at=now
+        )
+        result_path = self.retry_busy(job_id, self.model_worker.postprocess, job_id, encoded_outputs)
+        self.update(
+            db,
+            job_id,
+            status=models.JobStatus.COMPLETED,
+            result_path=result_path,
+            postprocess_finished_at=datetime.now(timezone.utc),
+        )
@@ -0,0 +1,43 @@
+import os
+
+
+def session_pids(sid: int) -> list[int]:
+    # Model processes run in their own session, which includes anything they forked
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[3]) == sid:
+            pids.append(int(entry))
+    return pids
+
+
+def process_memory(pid: int) -> int:
+    # Proportional set size, so pages shared copy-on-write by forked processes count once
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            key = 'Pss:'
+            lines = f.readlines()
+    except FileNotFoundError:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            key = 'VmRSS:'
+            lines = f.readlines()
+    for line in lines:
+        if line.startswith(key):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def process_cpu(pid: int) -> float:
+    # Seconds in user and kernel mode
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+
+from datetime import datetime, timezone
+
+from . import metrics
+from .model_worker import ModelWorker
+
+# Memory all model processes of this worker may use together, 80% of RAM unless configured
+MEMORY_BUDGET = int(os.getenv(
+    'AIS_MEMORY_BUDGET_MB',
+    os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * 0.8 // 2**20,
+)) * 2**20
+# Models used within this many seconds are not evicted
+MIN_IDLE = float(os.getenv('AIS_MODEL_MIN_IDLE', 10))
+# Seconds between budget checks, besides the one after every load
+CHECK_INTERVAL = float(os.getenv('AIS_RESIDENCY_INTERVAL', 30))
+
+
+class ResidencyManager:
+    """Keeps loaded models within a memory budget
+
+    When the model processes together use more than the budget, the least recently used
+    idle models are stopped. They are loaded again by the next job that needs them.
+    """
+
+    def __init__(self, load, on_load=None, on_evict=None, budget: int = MEMORY_BUDGET):
+        self.load = load
+        self.on_load = on_load
+        self.on_evict = on_evict
+        self.budget = budget
+
+        self.lock = threading.Lock()
+        # Loads take long, they must not block lookups of resident models
+        self.load_lock = threading.Lock()
+        self.model_workers: dict[int, ModelWorker] = {}
+        self.loads = 0
+        self.evictions = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def partition(self, count: int):
+        # Pool processes of one worker split its budget, like its cores
+        self.budget //= count
+
+    def __contains__(self, model_id: int) -> bool:
+        return model_id in self.model_workers
+
+    def __getitem__(self, model_id: int) -> ModelWorker:
+        return self.model_workers[model_id]
+
+    def get(self, model_id: int) -> ModelWorker:
+        with self.lock:
+            if model_id in self.model_workers:
+                model_worker = self.model_workers[model_id]
+                model_worker.last_used = time.time()
+                return model_worker
+
+        with self.load_lock:
+            if model_id in self.model_workers:
+                return self.model_workers[model_id]
+            with metrics.model_load_seconds.labels(model_id).time():
+                model_worker = self.load(model_id)
+            with self.lock:
+                self.model_workers[model_id] = model_worker
+                self.loads += 1
+
+        if self.on_load is not None:
+            self.on_load(model_id)
+        self.enforce_budget(keep=model_id)
+        return model_worker
+
+    def run(self):
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            try:
+                self.enforce_budget()
+            except Exception as e:
+                print(f'Failed to enforce memory budget: {e!r}')
+
+    def enforce_budget(self, keep: int | None = None):
+        evicted = []
+        with self.lock:
+            usage = {
+                model_id: model_worker.memory()
+                for model_id, model_worker in self.model_workers.items()
+            }
+            total = sum(usage.values())
+            if total <= self.budget:
+                return
+
+            now = time.time()
+            candidates = sorted(
+                (
+                    (model_id, model_worker) for model_id, model_worker in self.model_workers.items()
+                    if model_id != keep and model_worker.inflight == 0 and now - model_worker.last_used >= MIN_IDLE
+                ),
+                key=lambda item: item[1].last_used,
+            )
+            for model_id, model_worker in candidates:
+                if total <= self.budget:
+                    break
+                total -= usage[model_id]
+                del self.model_workers[model_id]
+                self.evictions += 1
+                evicted.append((model_id, model_worker))
+
+        if total > self.budget:
+            print(f'Resident models use {total // 2**20}MB, over the budget of {self.budget // 2**20}MB')
+
+        # Stopped outside the lock, other models keep loading meanwhile
+        for model_id, model_worker in evicted:
+            print(f'Evicting model {model_id}, idle for {time.time() - model_worker.last_used:.0f}s')
+            if self.on_evict is not None:
+                self.on_evict(model_id)
+            model_worker.stop()
+
+    def describe(self) -> dict:
+        with self.lock:
+            model_workers = list(self.model_workers.values())
+        now = time.time()
+        models = [
+            {
+                'model_id': model_worker.model.id,
+                'name': model_worker.model.name,
+                'pid': model_worker.process.pid if model_worker.process else os.getpid(),
+                'memory_mb': model_worker.memory() // 2**20,
+                'inflight': model_worker.inflight,
+                'last_used': datetime.fromtimestamp(model_worker.last_used, timezone.utc).isoformat(),
+                'idle_seconds': round(now - model_worker.last_used),
+            }
+            for model_worker in model_workers
+        ]
+        return {
+            'models': models,
+            'memory_mb': sum(model['memory_mb'] for model in models),
+            'budget_mb': self.budget // 2**20,
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,224 @@
+import hashlib
+import os
+import time
+
+import redis
+
+from sqlalchemy import update
+
+from . import events, models, object_storage
+
+REDIS_URL = os.getenv('REDIS_URL')
+# Seconds a result stays reusable by jobs with the same input, 0 turns the cache off
+TTL = float(os.getenv('AIS_RESULT_CACHE_TTL', 7 * 24 * 3600))
+# Results remembered at most, the least recently used ones are forgotten first
+MAX_ENTRIES = int(os.getenv('AIS_RESULT_CACHE_MAX_ENTRIES', 100000))
+# Seconds a running job stays the one its twins wait for, in case its worker died
+INFLIGHT_TTL = int(os.getenv('AIS_INFLIGHT_TTL', 3600))
+# Seconds between checks of a waiting job on its leader. Well below the broker's visibility
+# timeout (an hour with redis), which delivers delayed tasks again once they waited that long
+CHECK_INTERVAL = int(os.getenv('AIS_INFLIGHT_CHECK_INTERVAL', 300))
+
+RESULT_KEY = 'ais:cache:{key}'
+INFLIGHT_KEY = 'ais:inflight:{key}'
+ENTRIES_KEY = 'ais:cache:entries'  # key -> last use
+STATS_KEY = 'ais:cache:stats'
+
+# Metadata /files/ stores with every upload
+DIGEST_METADATA = 'sha256'
+CHUNK_SIZE = 1024 * 1024
+
+client = redis.Redis.from_url(REDIS_URL) if REDIS_URL and TTL > 0 else None
+
+# Deletes the claim of a job only while it holds it
+release_script = client.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+) if client is not None else None
+
+
+def input_digest(argument_path: str) -> str:
+    stat = object_storage.stat_object(argument_path)
+    digest = stat.metadata.get(f'x-amz-meta-{DIGEST_METADATA}')
+    if digest:
+        return digest
+
+    # Not uploaded through /files/
+    sha256 = hashlib.sha256()
+    res = object_storage.get_object(argument_path)
+    try:
+        for chunk in res.stream(CHUNK_SIZE):
+            sha256.update(chunk)
+    finally:
+        res.close()
+        res.release_conn()
+    return sha256.hexdigest()
+
+
+def job_key(db, model_id: int, argument_path: str) -> str | None:
+    """Identifies the result of a job: its model version and the SHA-256 of its input"""
+    if client is None:
+        return None
+    try:
+        model = db.query(models.Model).filter(models.Model.id == model_id).one()
+        version = object_storage.stat_object(model.module_path).etag.strip('"')
+        return f'{model_id}:{version}:{input_digest(argument_path)}'
+    except Exception as e:
+        # The job runs uncached and fails on its own if its input is missing
+        print(f'Failed to hash input {argument_path} of model {model_id}: {e!r}')
+        return None
+
+
+def lookup(key: str | None, count: bool = True) -> str | None:
+    if key is None:
+        return None
+    try:
+        result_path = client.get(RESULT_KEY.format(key=key))
+        if result_path is None:
+            if count:
+                client.hincrby(STATS_KEY, 'misses')
+            return None
+        if count:
+            client.hincrby(STATS_KEY, 'hits')
+        client.zadd(ENTRIES_KEY, {key: time.time()})
+        return result_path.decode()
+    except redis.RedisError as e:
+        print(f'Failed to look up result {key}: {e!r}')
+        return None
+
+
+def store(key: str, result_path: str):
+    now = time.time()
+    client.set(RESULT_KEY.format(key=key), result_path, ex=int(TTL))
+    client.zadd(ENTRIES_KEY, {key: now})
+    client.zremrangebyscore(ENTRIES_KEY, '-inf', now - TTL)
+
+    excess = client.zcard(ENTRIES_KEY) - MAX_ENTRIES
+    if excess > 0:
+        evicted = [member.decode() for member, _ in client.zpopmin(ENTRIES_KEY, excess)]
+        client.delete(*[RESULT_KEY.format(key=key) for key in evicted])
+        client.hincrby(STATS_KEY, 'evictions', len(evicted))
+
+
+def save(db, job: models.Job):
+    db.add(job)
+    db.commit()
+    # Clients following the job are told right away
+    events.publish(job.id, job.status, result_path=job.result_path, failed_log=job.failed_log)
+    if job.status in events.FINISHED:
+        finish(db, job)
+
+
+def claimant(key: str) -> int | None:
+    job_id = client.get(INFLIGHT_KEY.format(key=key))
+    return int(job_id) if job_id is not None else None
+
+
+def share(db, job: models.Job) -> bool:
+    """Whether the job can do without running its model
+
+    It is completed right away when the result of its input is cached, or waits for a
+    running job with the same input (its leader) and takes over that one's result.
+    A waiting job is checked again every CHECK_INTERVAL, see tasks.preprocess.
+    """
+    if job.leader_id is not None:
+        if job.status != models.JobStatus.PENDING:
+            return True
+        leader = db.query(models.Job).filter(models.Job.id == job.leader_id).one()
+        if leader.status in events.FINISHED:
+            resolve(db, leader)
+            return True
+        try:
+            if client is not None and claimant(job.cache_key) == leader.id:
+                return True
+        except redis.RedisError as e:
+            print(f'Failed to check claim of job {leader.id}: {e!r}')
+            return True
+        # The worker of the leader died, run the job instead
+        print(f'Job {job.id} stops waiting for job {leader.id}')
+        job.leader_id = None
+        db.commit()
+
+    if client is None:
+        return False
+    # Jobs created through /jobs/ were looked up already, count them once
+    counted = job.cache_key is not None
+    if not counted:
+        job.cache_key = job_key(db, job.model_id, job.argument_path)
+        if job.cache_key is None:
+            return False
+
+    result_path = lookup(job.cache_key, count=not counted)
+    if result_path is not None:
+        job.status = models.JobStatus.COMPLETED
+        job.result_path = result_path
+        save(db, job)
+        return True
+
+    try:
+        key = INFLIGHT_KEY.format(key=job.cache_key)
+        client.set(key, job.id, nx=True, ex=INFLIGHT_TTL)
+        leader_id = claimant(job.cache_key) or job.id
+    except redis.RedisError as e:
+        print(f'Failed to claim input of job {job.id}: {e!r}')
+        return False
+    if leader_id == job.id:
+        db.commit()
+        return False
+
+    print(f'Job {job.id} waits for job {leader_id} with the same input')
+    job.leader_id = leader_id
+    save(db, job)
+    client.hincrby(STATS_KEY, 'followers')
+
+    # The leader may have finished before it could see this job
+    leader = db.query(models.Job).filter(models.Job.id == leader_id).one()
+    if leader.status in events.FINISHED:
+        resolve(db, leader)
+    return True
+
+
+def resolve(db, leader: models.Job):
+    values = {'status': leader.status, 'result_path': leader.result_path, 'failed_log': leader.failed_log}
+    if leader.status == models.JobStatus.FAILED:
+        values['failed_log'] = f'Job {leader.id} with the same input failed: {leader.failed_log}'
+
+    # Only jobs still waiting, the leader and its followers may both get here
+    follower_ids = db.scalars(
+        update(models.Job)
+        .where(models.Job.leader_id == leader.id, models.Job.status == models.JobStatus.PENDING)
+        .values(values)
+        .returning(models.Job.id)
+    ).all()
+    db.commit()
+    for job_id in follower_ids:
+        events.publish(job_id, **values)
+
+
+def finish(db, job: models.Job):
+    """Shares the outcome of a finished job with the jobs that wait for it and later ones"""
+    if job.cache_key is None or job.leader_id is not None:
+        return
+    try:
+        if job.status == models.JobStatus.COMPLETED:
+            store(job.cache_key, job.result_path)
+        release_script(keys=[INFLIGHT_KEY.format(key=job.cache_key)], args=[job.id])
+    except redis.RedisError as e:
+        print(f'Failed to cache result of job {job.id}: {e!r}')
+    resolve(db, job)
+
+
+def stats() -> dict:
+    if client is None:
+        return {'enabled': False}
+    values = {field.decode(): int(value) for field, value in client.hgetall(STATS_KEY).items()}
+    hits = values.get('hits', 0)
+    misses = values.get('misses', 0)
+    return {
+        'enabled': True,
+        'entries': client.zcard(ENTRIES_KEY),
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else 0,
+        'followers': values.get('followers', 0),
+        'evictions': values.get('evictions', 0),
+    }
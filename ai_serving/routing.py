@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+
+import redis
+
+REDIS_URL = os.getenv('REDIS_URL')
+# Queue every worker consumes, jobs go there when no worker has their model loaded
+DEFAULT_QUEUE = 'celery'
+# Models sharing a queue, e.g. "vision=1,2,5;text=3,4". Other models get a queue of their own
+MODEL_GROUPS = os.getenv('AIS_MODEL_GROUPS', '')
+# Jobs waiting in a model queue before new jobs spill over to the default queue
+AFFINITY_MAX_BACKLOG = int(os.getenv('AIS_AFFINITY_MAX_BACKLOG', 8))
+# Seconds a worker's claim to have a model loaded lasts without being refreshed
+RESIDENT_TTL = float(os.getenv('AIS_RESIDENT_TTL', 60))
+
+RESIDENTS_KEY = 'ais:residents:{queue}'
+
+groups = {}  # model_id -> group name
+for spec in filter(None, MODEL_GROUPS.split(';')):
+    name, model_ids = spec.split('=')
+    for model_id in model_ids.split(','):
+        groups[int(model_id)] = name.strip()
+
+client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+
+def queue_name(model_id: int) -> str:
+    if model_id in groups:
+        return f'group.{groups[model_id]}'
+    return f'model.{model_id}'
+
+
+def queue_length(queue: str) -> int:
+    # The redis transport keeps each queue's messages in a list of the same name
+    return client.llen(queue)
+
+
+def is_resident(queue: str) -> bool:
+    return client.zcount(RESIDENTS_KEY.format(queue=queue), time.time(), '+inf') > 0
+
+
+def drain(queue: str):
+    # Nobody has the model loaded anymore, hand its waiting jobs to any worker
+    moved = 0
+    while client.rpoplpush(queue, DEFAULT_QUEUE) is not None:
+        moved += 1
+    if moved:
+        print(f'Moved {moved} jobs from {queue} to {DEFAULT_QUEUE}')
+
+
+def route(model_id: int) -> str:
+    """Queue for a job of the model
+
+    The model's own queue while some worker has the model loaded and keeps up with it,
+    otherwise the default queue, where any worker may pick the job up and load the model.
+    """
+    if client is None:
+        return DEFAULT_QUEUE
+    queue = queue_name(model_id)
+    try:
+        if is_resident(queue):
+            if queue_length(queue) < AFFINITY_MAX_BACKLOG:
+                return queue
+        elif queue_length(queue):
+            # Left behind by a worker that died with the model loaded
+            drain(queue)
+    except redis.RedisError as e:
+        print(f'Failed to route job of model {model_id}: {e!r}')
+    return DEFAULT_QUEUE
+
+
+class Residents:
+    """Advertises the models loaded by this worker process
+
+    The worker consumes the queue of every model it has loaded, and stops consuming it
+    once none of its processes have a model of that queue anymore.
+    """
+
+    def __init__(self, app, hostname: str):
+        self.app = app
+        self.hostname = hostname
+        self.member = f'{hostname}:{os.getpid()}'
+
+        self.lock = threading.Lock()
+        self.queues = {}  # queue -> model_ids loaded by this process
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, model_id: int):
+        queue = queue_name(model_id)
+        with self.lock:
+            self.queues.setdefault(queue, set()).add(model_id)
+        self.refresh(queue)
+        self.app.control.add_consumer(queue, destination=[self.hostname])
+        print(f'Consuming {queue} for model {model_id}')
+
+    def remove(self, model_id: int):
+        queue = queue_name(model_id)
+        with self.lock:
+            model_ids = self.queues.get(queue, set())
+            model_ids.discard(model_id)
+            if model_ids:
+                return
+            self.queues.pop(queue, None)
+
+        key = RESIDENTS_KEY.format(queue=queue)
+        client.zrem(key, self.member)
+        # Other processes of this worker may still have a model of the queue
+        members = client.zrangebyscore(key, time.time(), '+inf')
+        if any(member.decode().startswith(f'{self.hostname}:') for member in members):
+            return
+        self.app.control.cancel_consumer(queue, destination=[self.hostname])
+        if not members:
+            drain(queue)
+        print(f'Stopped consuming {queue}')
+
+    def refresh(self, queue: str):
+        key = RESIDENTS_KEY.format(queue=queue)
+        now = time.time()
+        client.zadd(key, {self.member: now + RESIDENT_TTL})
+        client.zremrangebyscore(key, '-inf', now)
+
+    def run(self):
+        while True:
+            time.sleep(RESIDENT_TTL / 3)
+            with self.lock:
+                queues = list(self.queues)
+            for queue in queues:
+                try:
+                    self.refresh(queue)
+                except redis.RedisError as e:
+                    print(f'Failed to advertise {queue}: {e!r}')
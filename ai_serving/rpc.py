@@ -0,0 +1,79 @@
+import itertools
+import socket
+import threading
+
+from concurrent.futures import Future
+
+from .worker_templates import common
+
+
+class Connection:
+    """Long-lived connection to a model process
+
+    Every request carries an id, so concurrent calls share the socket and replies may
+    arrive in any order. A reader thread hands each reply to the future of its request.
+    """
+
+    def __init__(self, path: str):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending: dict[int, Future] = {}
+        self.error: Exception | None = None
+
+        self.reader = threading.Thread(target=self.read_replies, daemon=True)
+        self.reader.start()
+
+    @property
+    def closed(self) -> bool:
+        return self.error is not None
+
+    def submit(self, command: bytes, *buffers, flags: int = 0) -> Future:
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                raise ConnectionError(f'Connection to model is closed: {self.error}')
+            request_id = next(self.ids) & 0xFFFFFFFF
+            self.pending[request_id] = future
+
+        try:
+            with self.write_lock:
+                common.send_frame(self.sock, command, *buffers, flags=flags, request_id=request_id)
+        except OSError as e:
+            self.fail(e)
+            raise
+
+        return future
+
+    def request(self, command: bytes, *buffers, flags: int = 0) -> tuple[bytes, bytearray]:
+        return self.submit(command, *buffers, flags=flags).result()
+
+    def read_replies(self):
+        try:
+            while True:
+                resp, _, request_id, arg = common.recv_frame(self.sock)
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result((resp, arg))
+        except Exception as e:
+            self.fail(e)
+
+    def fail(self, error: Exception):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError(f'Connection to model lost: {error}'))
+        self.sock.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.fail(ConnectionError('Closed'))
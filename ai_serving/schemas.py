@@ -22,11 +22,37 @@ class ModelCreate(BaseModel):
     name: str
 
 
+class StageTiming(BaseModel):
+    # Seconds, None without jobs
+    mean: float | None
+    p50: float | None
+    p95: float | None
+    p99: float | None
+    max: float | None
+
+
+class ModelTimings(BaseModel):
+    model_id: int
+    jobs: int
+    cold_starts: int
+    stages: dict[str, StageTiming]
+
+
 class Job(ItemBase):
     id: int
     status: JobStatus
     result_path: str | None
     failed_log: str | None
+    batch_id: str | None
+    leader_id: int | None
+    preprocess_started_at: datetime | None = None
+    preprocess_finished_at: datetime | None = None
+    inference_started_at: datetime | None = None
+    inference_finished_at: datetime | None = None
+    postprocess_started_at: datetime | None = None
+    postprocess_finished_at: datetime | None = None
+    worker_host: str | None = None
+    cold_start: bool = False
 
     class Config:
         orm_mode = True
@@ -37,5 +63,34 @@ class JobCreate(BaseModel):
     argument_path: str
 
 
+class JobBatchCreate(BaseModel):
+    jobs: list[JobCreate]
+    # Generated unless given, e.g. to add jobs to an earlier batch
+    batch_id: str | None = None
+
+
+class JobBatchCreated(BaseModel):
+    batch_id: str
+    job_ids: list[int]
+
+
+class Batch(BaseModel):
+    batch_id: str
+    total: int
+    finished: int
+    statuses: dict[JobStatus, int]
+
+
+class CacheStats(BaseModel):
+    enabled: bool
+    entries: int = 0
+    hits: int = 0
+    misses: int = 0
+    hit_rate: float = 0
+    # Jobs that waited for a running job with the same input
+    followers: int = 0
+    evictions: int = 0
+
+
 class FileCreated(BaseModel):
     path: str
@@ -0,0 +1,85 @@
+import io
+import os
+import socket
+import time
+import uuid
+
+import appdirs
+
+from . import object_storage
+from .worker_templates import common
+
+SPILL_DIR = os.getenv('AIS_SPILL_DIR', os.path.join(appdirs.user_cache_dir('ais_'), 'spill'))
+# Also upload intermediate tensors, so that the next stage may run on any node instead of this one
+SPILL_REMOTE = os.getenv('AIS_SPILL_REMOTE', 'false').lower() == 'true'
+# Local spill files older than this belong to jobs that never reached their next stage
+SPILL_MAX_AGE = int(os.getenv('AIS_SPILL_MAX_AGE', 24 * 3600))
+
+HOSTNAME = socket.gethostname()
+
+# Small JSON-serialisable reference to spilled data, passed between tasks instead of the data
+Handle = dict
+
+
+def put(key: str, data: bytes) -> Handle:
+    os.makedirs(SPILL_DIR, exist_ok=True)
+    name = f'{key}-{uuid.uuid4().hex}'
+    path = os.path.join(SPILL_DIR, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    handle = {'host': HOSTNAME, 'path': path, 'size': len(data)}
+
+    if SPILL_REMOTE:
+        if common.is_shm(data):
+            # Shared memory only exists on this node, ship the arrays themselves
+            data = common.ndarraylist_to_bytes(common.bytes_to_ndarraylist(data))
+        object_path = f'spill/{name}'
+        object_storage.put_object(object_path, io.BytesIO(data))
+        handle['object_path'] = object_path
+
+    return handle
+
+
+def get(handle: Handle) -> bytes:
+    if handle['host'] == HOSTNAME and os.path.exists(handle['path']):
+        with open(handle['path'], 'rb') as f:
+            return f.read()
+
+    if 'object_path' not in handle:
+        raise RuntimeError(
+            f'Intermediate data of {handle["host"]} is not reachable from {HOSTNAME}, '
+            'set AIS_SPILL_REMOTE=true when stages run on different nodes'
+        )
+
+    res = object_storage.get_object(handle['object_path'])
+    try:
+        return res.read()
+    finally:
+        res.close()
+        res.release_conn()
+
+
+def delete(handle: Handle):
+    if handle['host'] == HOSTNAME:
+        try:
+            with open(handle['path'], 'rb') as f:
+                data = f.read(len(common.SHM_MAGIC))
+                if common.is_shm(data):
+                    data += f.read()
+            # Segments are released by the model, unless the stage failed before reaching it
+            common.release_shm(data)
+            os.unlink(handle['path'])
+        except FileNotFoundError:
+            pass
+    if 'object_path' in handle:
+        object_storage.remove_object(handle['object_path'])
+
+
+def sweep():
+    if not os.path.isdir(SPILL_DIR):
+        return
+    now = time.time()
+    for entry in os.scandir(SPILL_DIR):
+        if now - entry.stat().st_mtime > SPILL_MAX_AGE:
+            os.unlink(entry.path)
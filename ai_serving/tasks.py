@@ -1,120 +1,352 @@
+import base64
 import os
+import socket
+import tempfile
+import threading
+import time
 
-import numpy as np
+from datetime import datetime, timedelta, timezone
 
+from billiard.process import current_process
 from celery import Celery
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.signals import before_task_publish, celeryd_init, worker_process_init, worker_process_shutdown
+from celery.signals import worker_ready, worker_shutdown
+from celery.utils import worker_direct
 from celery.utils.log import get_task_logger
+from celery.worker.control import inspect_command
+from sqlalchemy import func
 
-from . import models, object_storage
+from . import cpu_manager, metrics, models, object_storage, result_cache, routing, spill
+from .autoscaler import Autoscaler
 from .database import SessionLocal
-from .model_worker import ModelWorker
-
-EncodedInputs = bytes
+from .model_worker import ModelBusyError, ModelWorker, unpack_model_files
+from .onnx_worker import OnnxModelWorker
+from .pipeline import BUSY_RETRY_DELAY, FusedPipeline
+from .residency import ResidencyManager
+from .result_cache import save
+from .worker_templates import common
 
 
 REDIS_URL = os.getenv('REDIS_URL')
+# Models loaded at worker start, e.g. "1,5". Unless set, the most used ones recently
+PRELOAD_MODELS = os.getenv('AIS_PRELOAD_MODELS', '')
+PRELOAD_TOP = int(os.getenv('AIS_PRELOAD_TOP', 2))
+PRELOAD_WINDOW = float(os.getenv('AIS_PRELOAD_WINDOW_HOURS', 24))
 
 app = Celery('tasks', backend='rpc://', broker=REDIS_URL)
+# Every worker also consumes a queue of its own, for stages whose data it keeps locally
+app.conf.worker_direct = True
 
-model_workers = {}  # model_id -> ModelWorker
+pipelines = {}  # model_id -> FusedPipeline
 
 logger = get_task_logger(__name__)
 
 
-def load_model(model_id: int):
-    global model_workers
-
-    if model_id in model_workers:
-        # Model already loaded
+def setup_model(model_id: int) -> ModelWorker:
+    db = SessionLocal()
+    try:
+        print(f'Setting up model {model_id}')
+        model = db.query(models.Model).filter(models.Model.id == model_id).one()
+        # ais.json says how the model is served
+        config = common.load_config(unpack_model_files(model))
+        if config.get('type') == 'onnx':
+            return OnnxModelWorker(model)
+        return ModelWorker(model)
+    finally:
+        db.close()
+
+
+def advertise_model(model_id: int):
+    global autoscaler, residents
+
+    if autoscaler is None:
+        # Only in processes that load models
+        autoscaler = Autoscaler(model_workers)
+    if hostname is None:
+        # Not running inside a celery worker
         return
+    if residents is None:
+        # Created in the process that loads models, after the pool forked
+        residents = routing.Residents(app, hostname)
+    residents.add(model_id)
+
+
+def unload_model(model_id: int):
+    if residents is not None:
+        residents.remove(model_id)
+    pipeline = pipelines.pop(model_id, None)
+    if pipeline is not None:
+        pipeline.stop()
+
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def stop_pipelines(**kwargs):
+    # Fused jobs are not redelivered, finish them or mark them failed
+    for model_id in list(pipelines):
+        pipelines.pop(model_id).stop()
+
+
+model_workers = ResidencyManager(setup_model, on_load=advertise_model, on_evict=unload_model)
+hostname = None
+concurrency = 1
+residents = None
+autoscaler = None
+
+
+@before_task_publish.connect
+def stamp_task(headers=None, **kwargs):
+    # Shows up as self.request.ais_sent_at, to measure how long the task waited in its queue
+    headers['ais_sent_at'] = time.time()
+
+
+def observe_queue_wait(task, model_id: int):
+    sent_at = getattr(task.request, 'ais_sent_at', None)
+    if sent_at is not None:
+        metrics.stage_seconds.labels(model_id, 'queue_wait').observe(max(0, time.time() - sent_at))
+
+
+@celeryd_init.connect
+def remember_hostname(sender, options=None, **kwargs):
+    global concurrency, hostname
+
+    hostname = sender
+    concurrency = (options or {}).get('concurrency') or os.cpu_count()
+
+
+def next_stage_queue(model_id: int, handle: spill.Handle):
+    if 'object_path' in handle or hostname is None:
+        # Any worker can read the data
+        return routing.route(model_id)
+    # Spilled to this node only
+    return worker_direct(hostname)
+
+
+def load_model(model_id: int) -> ModelWorker:
+    # Loads the model unless it is resident already
+    return model_workers.get(model_id)
+
+
+def load_job_model(job: models.Job) -> ModelWorker:
+    if job.model_id not in model_workers:
+        job.cold_start = True
+    return load_model(job.model_id)
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def get_pipeline(model_worker: ModelWorker) -> FusedPipeline:
+    model_id = model_worker.model.id
+    if model_id not in pipelines:
+        pipelines[model_id] = FusedPipeline(model_worker, model_worker.pipeline_depth)
+    return pipelines[model_id]
+
+
+@inspect_command()
+def resident_models(state):
+    """Models loaded in this worker, their memory use and idle time"""
+    return {**model_workers.describe(), 'cpus': cpu_manager.describe()}
+
+
+@worker_ready.connect
+def sweep_spill(**kwargs):
+    spill.sweep()
+
+
+def hot_models() -> list[int]:
+    if PRELOAD_MODELS:
+        return [int(model_id) for model_id in PRELOAD_MODELS.split(',')]
 
     db = SessionLocal()
-    print(f'Setting up model {model_id}')
-    model = db.query(models.Model).filter(models.Model.id == model_id).one()
-    model_workers[model_id] = ModelWorker(model)
+    try:
+        since = datetime.now(timezone.utc) - timedelta(hours=PRELOAD_WINDOW)
+        rows = (
+            db.query(models.Job.model_id)
+            .filter(models.Job.created_at >= since)
+            .group_by(models.Job.model_id)
+            .order_by(func.count().desc())
+            .limit(PRELOAD_TOP)
+            .all()
+        )
+        return [model_id for model_id, in rows]
+    finally:
+        db.close()
+
+
+def preload_models():
+    for model_id in hot_models():
+        try:
+            load_model(model_id)
+        except Exception as e:
+            print(f'Failed to preload model {model_id}: {e!r}')
+
+
+def start_metrics(offset: int):
+    metrics.register(metrics.ModelCollector(model_workers))
+    metrics.serve(offset)
+
+
+@worker_ready.connect
+def start_preload(sender, **kwargs):
+    if isinstance(sender.pool, PreforkPool):
+        # Models are loaded by the pool processes, not the parent, which forks them
+        return
+    start_metrics(0)
+    # In the background, the worker takes jobs meanwhile
+    threading.Thread(target=preload_models, daemon=True).start()
+
 
+@worker_process_init.connect
+def start_process_preload(**kwargs):
+    # Pool processes load models of their own, each gets a share of the cores and memory
+    index = getattr(current_process(), 'index', 0)
+    cpu_manager.partition(index, concurrency)
+    model_workers.partition(concurrency)
+    start_metrics(1 + index)
+    threading.Thread(target=preload_models, daemon=True).start()
 
-@app.task
-def preprocess(job_id: int):
+
+@app.task(bind=True, max_retries=None)
+def preprocess(self, job_id: int):
     db = SessionLocal()
     print(f'Preprocessing job {job_id}')
     job = db.query(models.Job).filter(models.Job.id == job_id).one()
+    observe_queue_wait(self, job.model_id)
+
+    if job.status != models.JobStatus.PENDING and not self.request.retries:
+        # Delivered twice, or a check of a waiting job that finished meanwhile
+        print(f'Job {job_id} is {job.status.value} already')
+        return
+
+    if result_cache.share(db, job):
+        # Completed from the cache, or takes the result of a running job with the same input
+        if job.status == models.JobStatus.PENDING:
+            # Checks on the leader until it finished, and runs the job itself should its worker die
+            preprocess.apply_async(
+                (job_id,), queue=routing.route(job.model_id), countdown=result_cache.CHECK_INTERVAL
+            )
+        return
 
     job.status = models.JobStatus.PREPROCESSING
-    db.add(job)
-    db.commit()
+    job.preprocess_started_at = utcnow()
+    job.worker_host = hostname or socket.gethostname()
+    save(db, job)
 
     try:
         # Ensure model is loaded
-        load_model(job.model_id)
-
-        inputs = model_workers[job.model_id].preprocess(job.argument_path)
+        model_worker = load_job_model(job)
+
+        if model_worker.pipeline == 'fused':
+            # Only writes when the model was loaded for this job
+            db.commit()
+            # Remaining stages run in this worker, overlapped with other jobs of the model
+            get_pipeline(model_worker).submit(job_id, job.argument_path)
+            return
+
+        inputs = spill.put(f'{job_id}-inputs', model_worker.preprocess(job.argument_path))
+    except ModelBusyError as e:
+        raise self.retry(exc=e, countdown=BUSY_RETRY_DELAY)
     except Exception as e:
         job.status = models.JobStatus.FAILED
         job.failed_log = str(e)
-        db.add(job)
-        db.commit()
+        save(db, job)
         raise e
 
     job.status = models.JobStatus.PREPROCESSED
-    db.add(job)
-    db.commit()
+    job.preprocess_finished_at = utcnow()
+    save(db, job)
 
-    inference.delay(job_id, inputs)
+    # Stays with the workers that have the model loaded, or this one while the data is local
+    inference.apply_async((job_id, inputs), queue=next_stage_queue(job.model_id, inputs))
 
 
-@app.task
-def inference(job_id: int, inputs: EncodedInputs):
+@app.task(bind=True, max_retries=None)
+def inference(self, job_id: int, inputs: spill.Handle):
     db = SessionLocal()
     print(f'Inferencing job {job_id}')
     job = db.query(models.Job).filter(models.Job.id == job_id).one()
+    observe_queue_wait(self, job.model_id)
 
     job.status = models.JobStatus.INFERENCING
-    db.add(job)
-    db.commit()
+    job.inference_started_at = utcnow()
+    job.worker_host = hostname or socket.gethostname()
+    save(db, job)
 
     try:
         # Ensure model is loaded
-        load_model(job.model_id)
+        model_worker = load_job_model(job)
 
-        outputs = model_workers[job.model_id].inference(inputs)
+        outputs = spill.put(f'{job_id}-outputs', model_worker.inference(spill.get(inputs)))
+    except ModelBusyError as e:
+        raise self.retry(exc=e, countdown=BUSY_RETRY_DELAY)
     except Exception as e:
         job.status = models.JobStatus.FAILED
         job.failed_log = str(e)
-        db.add(job)
-        db.commit()
+        save(db, job)
+        spill.delete(inputs)
         raise e
 
+    spill.delete(inputs)
+
     job.status = models.JobStatus.INFERENCED
-    db.add(job)
-    db.commit()
+    job.inference_finished_at = utcnow()
+    save(db, job)
 
-    postprocess.delay(job_id, outputs)
+    postprocess.apply_async((job_id, outputs), queue=next_stage_queue(job.model_id, outputs))
 
 
-@app.task
-def postprocess(job_id: int, outputs: list[np.ndarray]):
+@app.task(bind=True, max_retries=None)
+def postprocess(self, job_id: int, outputs: spill.Handle):
     db = SessionLocal()
     print(f'Postprocessing job {job_id}')
     job = db.query(models.Job).filter(models.Job.id == job_id).one()
+    observe_queue_wait(self, job.model_id)
 
     job.status = models.JobStatus.POSTPROCESSING
-    db.add(job)
-    db.commit()
+    job.postprocess_started_at = utcnow()
+    job.worker_host = hostname or socket.gethostname()
+    save(db, job)
 
     try:
         # Ensure model is loaded
-        load_model(job.model_id)
+        model_worker = load_job_model(job)
 
-        result_path = model_workers[job.model_id].postprocess(job, outputs)
+        result_path = model_worker.postprocess(job_id, spill.get(outputs))
+    except ModelBusyError as e:
+        raise self.retry(exc=e, countdown=BUSY_RETRY_DELAY)
     except Exception as e:
         job.status = models.JobStatus.FAILED
         job.failed_log = str(e)
-        db.add(job)
-        db.commit()
+        save(db, job)
+        spill.delete(outputs)
         raise e
 
+    spill.delete(outputs)
+
     job.status = models.JobStatus.COMPLETED
     job.result_path = result_path
-    db.add(job)
-    db.commit()
+    job.postprocess_finished_at = utcnow()
+    save(db, job)
+
+
+@app.task(bind=True, max_retries=None)
+def predict(self, model_id: int, data: str) -> str:
+    # Input and result are base64 in the message, no job, object storage or spill involved
+    observe_queue_wait(self, model_id)
+    model_worker = load_model(model_id)
+
+    fd, path = tempfile.mkstemp(prefix='ais_')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(base64.b64decode(data))
+    try:
+        with metrics.stage_seconds.labels(model_id, 'predict').time():
+            result = model_worker.predict_file(path)
+    except ModelBusyError as e:
+        raise self.retry(exc=e, countdown=BUSY_RETRY_DELAY)
+    finally:
+        os.unlink(path)
+
+    return base64.b64encode(result).decode()
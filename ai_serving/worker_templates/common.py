@@ -1,29 +1,372 @@
-import base64
-import io
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
 
 import numpy as np
 
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 SOCK_NAME = 'ais.sock'
-SEPARATOR = b'|'
+# Socket of each serving process in replica mode
+REPLICA_SOCK_NAME = 'ais.{}.sock'
+SHM_DIR_NAME = 'shm'
+# Directory of the sockets and shm segments, one per worker process sharing the model files
+RUNTIME_DIR_ENV = 'AIS_RUNTIME_DIR'
+CONFIG_NAME = 'ais.json'
+
+# Pipe on which the model process reports STATUS_READY, or STATUS_FAILED and a traceback
+STATUS_FD_ENV = 'AIS_STATUS_FD'
+STATUS_READY = b'ready\n'
+STATUS_FAILED = b'failed\n'
 
+CMD_HELLO = b'0'
 CMD_PREPROCESS = b'1'
 CMD_INFERENCE = b'2'
 CMD_POSTPROCESS = b'3'
+CMD_PING = b'4'
+# Replica mode only, sent to the parent on SOCK_NAME: run the given number of replicas
+CMD_SCALE = b'5'
 
 RESP_OK = b'0'
 RESP_ERR = b'1'
+# Too many requests pending, the payload says how many
+RESP_BUSY = b'2'
+
+# Every message is a frame: command, flags, request id and payload length, then the payload.
+# Replies carry the id of their request, so several requests can share a connection.
+FRAME_HEADER = struct.Struct('!cBIQ')
+
+# Request flag: reply with shared memory descriptors instead of array data
+FLAG_SHM = 0x01
+
+# Tensor payloads: magic and metadata length, JSON metadata, then raw array data
+TENSOR_MAGIC = b'AIST'
+TENSOR_HEADER = struct.Struct('!4sI')
+# Shared memory descriptors: magic, then JSON with the segment path and array layout
+SHM_MAGIC = b'AISM'
+
+# Upper bound of a single send/recv call, so huge payloads never need a second buffer
+CHUNK_SIZE = 1 << 20
+# Array data is aligned so that the receiver can map it without copying
+ALIGNMENT = 64
+
+
+def _align(offset: int) -> int:
+    return -offset % ALIGNMENT
+
+
+def load_config(model_dir: str) -> dict:
+    path = os.path.join(model_dir, CONFIG_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+class Codec:
+    """Tensor codec
+
+    Array codecs (casts) transform each array and record what they need to undo it,
+    byte codecs compress the whole array data section. Codecs are chained with '+',
+    e.g. 'fp16+zstd'.
+    """
+    name = None
+    compresses = False
+
+    def encode(self, array: np.ndarray) -> tuple[np.ndarray, dict | None]:
+        return array, None
+
+    def decode(self, array: np.ndarray, meta: dict) -> np.ndarray:
+        return array
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+CODECS: dict[str, Codec] = {}
+
+
+def register_codec(cls):
+    CODECS[cls.name] = cls()
+    return cls
+
+
+@register_codec
+class RawCodec(Codec):
+    name = 'raw'
+
+
+@register_codec
+class ZlibCodec(Codec):
+    name = 'zlib'
+    compresses = True
+
+    def compress(self, data):
+        return zlib.compress(data, 1)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+if lz4 is not None:
+    @register_codec
+    class Lz4Codec(Codec):
+        name = 'lz4'
+        compresses = True
+
+        def compress(self, data):
+            return lz4.frame.compress(data)
+
+        def decompress(self, data):
+            return lz4.frame.decompress(data)
+
+
+if zstandard is not None:
+    @register_codec
+    class ZstdCodec(Codec):
+        name = 'zstd'
+        compresses = True
+
+        def compress(self, data):
+            return zstandard.ZstdCompressor(level=1).compress(data)
+
+        def decompress(self, data):
+            return zstandard.ZstdDecompressor().decompress(data)
+
+
+@register_codec
+class Float16Codec(Codec):
+    name = 'fp16'
+
+    def encode(self, array):
+        if array.dtype.kind != 'f' or array.dtype.itemsize <= 2:
+            return array, None
+        return array.astype('<f2'), {'dtype': array.dtype.str}
+
+    def decode(self, array, meta):
+        return array.astype(meta['dtype'])
 
 
-def bytes_to_ndarraylist(arg: bytes) -> list[np.ndarray]:
-    f = io.BytesIO(arg)
-    npz = np.load(f)
+@register_codec
+class Int8Codec(Codec):
+    name = 'int8'
+
+    def encode(self, array):
+        if array.dtype.kind != 'f' or array.size == 0:
+            return array, None
+        peak = float(np.max(np.abs(array)))
+        if peak == 0 or not np.isfinite(peak):
+            return array, None
+        scale = peak / 127
+        quantized = np.clip(np.rint(array / scale), -127, 127).astype(np.int8)
+        return quantized, {'dtype': array.dtype.str, 'scale': scale}
+
+    def decode(self, array, meta):
+        return array.astype(meta['dtype']) * np.array(meta['scale'], dtype=meta['dtype'])
+
+
+def parse_codec(spec: str) -> list[Codec]:
+    try:
+        return [CODECS[name] for name in spec.split('+')]
+    except KeyError as e:
+        raise ValueError(f'Unknown codec: {e.args[0]}')
+
+
+def supports_codec(spec: str) -> bool:
+    return all(name in CODECS for name in spec.split('+'))
+
+
+def negotiate_codec(candidates: list[str]) -> str:
+    # First candidate both sides support, in the caller's order of preference
+    for spec in candidates:
+        if supports_codec(spec):
+            return spec
+    return RawCodec.name
+
+
+def recv_exact(sock, length: int) -> bytearray:
+    buf = bytearray(length)
+    view = memoryview(buf)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view[received:], min(length - received, CHUNK_SIZE))
+        if n == 0:
+            raise ConnectionError(f'Connection closed after {received} of {length} bytes')
+        received += n
+    return buf
+
+
+def send_frame(sock, command: bytes, *buffers, flags: int = 0, request_id: int = 0) -> int:
+    views = [memoryview(buf).cast('B') for buf in buffers]
+    length = sum(view.nbytes for view in views)
+    sock.sendall(FRAME_HEADER.pack(command, flags, request_id, length))
+    for view in views:
+        for offset in range(0, view.nbytes, CHUNK_SIZE):
+            sock.sendall(view[offset:offset + CHUNK_SIZE])
+    return length
+
+
+def recv_frame(sock) -> tuple[bytes, int, int, bytearray]:
+    command, flags, request_id, length = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+    return command, flags, request_id, recv_exact(sock, length)
+
+
+def _layout(arg: list[np.ndarray], codecs: list[Codec] = ()) -> tuple[list[dict], list[np.ndarray], int]:
+    arrays = []
+    specs = []
+    offset = 0
+    for array in arg:
+        array = np.asanyarray(array)
+        if array.dtype.hasobject:
+            raise TypeError(f'Cannot encode array of dtype {array.dtype}')
+        spec = {}
+        for codec in codecs:
+            array, meta = codec.encode(array)
+            if meta is not None:
+                spec[codec.name] = meta
+        data = np.require(array, dtype=array.dtype.newbyteorder('<'), requirements='C')
+        offset += _align(offset)
+        spec.update({
+            'dtype': data.dtype.str,
+            'shape': list(array.shape),
+            'strides': list(data.strides) if array.ndim else [],
+            'offset': offset,
+        })
+        specs.append(spec)
+        arrays.append(data)
+        offset += data.nbytes
+    return specs, arrays, offset
+
+
+def ndarraylist_to_buffers(arg: list[np.ndarray], codec: str = RawCodec.name) -> list:
+    codecs = parse_codec(codec)
+    specs, arrays, size = _layout(arg, codecs)
+
+    body = []
+    position = 0
+    for spec, data in zip(specs, arrays):
+        if spec['offset'] > position:
+            body.append(bytes(spec['offset'] - position))
+        body.append(data.reshape(-1).view(np.uint8))
+        position = spec['offset'] + data.nbytes
+
+    compressors = [c for c in codecs if c.compresses]
+    if compressors:
+        data = b''.join(body)
+        for compressor in compressors:
+            data = compressor.compress(data)
+        body = [data]
+
+    meta = json.dumps({'codec': codec, 'size': size, 'arrays': specs}).encode()
+    meta += b' ' * _align(TENSOR_HEADER.size + len(meta))
+
+    return [TENSOR_HEADER.pack(TENSOR_MAGIC, len(meta)), meta, *body]
+
+
+def ndarraylist_to_shm(arg: list[np.ndarray], directory: str) -> bytes:
+    specs, arrays, size = _layout(arg)
+
+    fd, path = tempfile.mkstemp(prefix='seg_', dir=directory)
+    try:
+        # mmap refuses empty files
+        os.ftruncate(fd, max(size, 1))
+        with mmap.mmap(fd, max(size, 1)) as segment:
+            for spec, data in zip(specs, arrays):
+                segment[spec['offset']:spec['offset'] + data.nbytes] = data.reshape(-1).view(np.uint8)
+    finally:
+        os.close(fd)
+
+    return SHM_MAGIC + json.dumps({'path': path, 'arrays': specs}).encode()
+
+
+def is_shm(arg) -> bool:
+    return bytes(memoryview(arg)[:len(SHM_MAGIC)]) == SHM_MAGIC
+
+
+def shm_to_ndarraylist(arg) -> list[np.ndarray]:
+    meta = json.loads(bytes(memoryview(arg)[len(SHM_MAGIC):]))
+    with open(meta['path'], 'rb') as f:
+        # Private mapping: the arrays are writable but never modify the segment
+        segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
     return [
-        npz[key]
-        for key in npz.files
+        np.ndarray(
+            spec['shape'],
+            dtype=spec['dtype'],
+            buffer=segment,
+            offset=spec['offset'],
+            strides=spec['strides'] or None,
+        )
+        for spec in meta['arrays']
     ]
 
 
-def ndarraylist_to_bytes(arg: list[np.ndarray]) -> bytes:
-    f = io.BytesIO()
-    np.savez_compressed(f, *arg)
-    return f.getvalue()
+def release_shm(arg):
+    if not is_shm(arg):
+        return
+    meta = json.loads(bytes(memoryview(arg)[len(SHM_MAGIC):]))
+    try:
+        os.unlink(meta['path'])
+    except FileNotFoundError:
+        pass
+
+
+def sweep_shm(directory: str, max_age: float):
+    # Remove segments left behind by crashed stages
+    now = time.time()
+    for entry in os.scandir(directory):
+        if entry.name.startswith('seg_') and now - entry.stat().st_mtime > max_age:
+            os.unlink(entry.path)
+
+
+def bytes_to_ndarraylist(arg) -> list[np.ndarray]:
+    if is_shm(arg):
+        return shm_to_ndarraylist(arg)
+
+    view = memoryview(arg).cast('B')
+    magic, meta_length = TENSOR_HEADER.unpack_from(view)
+    if magic != TENSOR_MAGIC:
+        raise ValueError('Payload is not an encoded tensor list')
+    start = TENSOR_HEADER.size + meta_length
+    meta = json.loads(bytes(view[TENSOR_HEADER.size:start]))
+
+    codecs = parse_codec(meta.get('codec', RawCodec.name))
+    compressors = [c for c in codecs if c.compresses]
+    if compressors:
+        data = bytes(view[start:])
+        for compressor in reversed(compressors):
+            data = compressor.decompress(data)
+        view = memoryview(data)
+        start = 0
+
+    arrays = []
+    for spec in meta['arrays']:
+        array = np.frombuffer(
+            view,
+            dtype=spec['dtype'],
+            count=int(np.prod(spec['shape'], dtype=np.int64)),
+            offset=start + spec['offset'],
+        ).reshape(spec['shape'])
+        for codec in reversed(codecs):
+            if codec.name in spec:
+                array = codec.decode(array, spec[codec.name])
+        arrays.append(array)
+    return arrays
+
+
+def ndarraylist_to_bytes(arg: list[np.ndarray], codec: str = RawCodec.name) -> bytes:
+    return b''.join(ndarraylist_to_buffers(arg, codec))
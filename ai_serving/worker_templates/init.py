@@ -1,35 +1,82 @@
+import functools
+import gc
+import json
+import multiprocessing
 import os
+import queue
+import signal
 import socket
 import tempfile
+import threading
 import traceback
 
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from typing import TYPE_CHECKING
 
-from common import bytes_to_ndarraylist, ndarraylist_to_bytes
-from common import CMD_INFERENCE, CMD_POSTPROCESS, CMD_PREPROCESS
-from common import RESP_ERR, RESP_OK
-from common import SEPARATOR, SOCK_NAME
+from common import bytes_to_ndarraylist, ndarraylist_to_buffers, ndarraylist_to_shm
+from common import CMD_HELLO, CMD_INFERENCE, CMD_PING, CMD_POSTPROCESS, CMD_PREPROCESS, CMD_SCALE
+from common import FLAG_SHM
+from common import load_config
+from common import negotiate_codec, RawCodec
+from common import recv_frame, send_frame
+from common import REPLICA_SOCK_NAME, RUNTIME_DIR_ENV, SHM_DIR_NAME, SOCK_NAME
+from common import RESP_BUSY, RESP_ERR, RESP_OK
+from common import STATUS_FAILED, STATUS_FD_ENV, STATUS_READY
 
 if TYPE_CHECKING:
     import numpy as np
 
 
-# Open unix socket to communicate with the parent process
-sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-if os.path.exists(SOCK_NAME):
-    os.unlink(SOCK_NAME)
-sock.bind(SOCK_NAME)
-sock.listen(1)
+# e.g. {"concurrency": 4, "executor": "thread", "max_pending": 64}
+server_config = load_config('model').get('server', {})
+# Preprocess/postprocess calls running at once
+CONCURRENCY = server_config.get('concurrency', 4)
+# 'thread' or 'process', the latter for stages holding the GIL
+EXECUTOR = server_config.get('executor', 'thread')
+# Requests accepted before callers are told to back off
+MAX_PENDING = server_config.get('max_pending', 64)
+# Serving processes forked after load(), sharing the loaded model copy-on-write
+REPLICAS = server_config.get('replicas', 1)
+# The worker may scale the replicas up to this many
+MAX_REPLICAS = server_config.get('max_replicas', REPLICAS)
+
+
+def bind(path: str) -> socket.socket:
+    # Open unix socket to communicate with the parent process
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        os.unlink(path)
+    sock.bind(path)
+    sock.listen(MAX_PENDING)
+    return sock
+
+
+RUNTIME_DIR = os.path.abspath(os.environ.get(RUNTIME_DIR_ENV, '.'))
+
+# In replica mode SOCK_NAME is the control socket of the parent
+sock = bind(os.path.join(RUNTIME_DIR, SOCK_NAME))
+if MAX_REPLICAS > 1:
+    sockets = [bind(os.path.join(RUNTIME_DIR, REPLICA_SOCK_NAME.format(index))) for index in range(MAX_REPLICAS)]
+
+SHM_DIR = os.path.join(RUNTIME_DIR, SHM_DIR_NAME)
+os.makedirs(SHM_DIR, exist_ok=True)
+
+
+def report(status: bytes, detail: str = ''):
+    # Tell the worker whether the model is usable, once
+    fd = os.environ.pop(STATUS_FD_ENV, None)
+    if fd is None:
+        return
+    with os.fdopen(int(fd), 'wb') as f:
+        f.write(status + detail.encode())
+
 
 # Load & Initialise model
 try:
     from model.main import inference, load, postprocess, preprocess
     load()
 except Exception as e:
-    # Write the error to file
-    with open('error.txt', 'w') as f:
-        tb = traceback.format_exc()
-        f.write(tb)
+    report(STATUS_FAILED, traceback.format_exc())
     raise e
 
 
@@ -37,23 +84,29 @@ except Exception as e:
 os.chdir('model')
 
 
-def do_preprocess(arg: bytes) -> bytes:
+def encode(arrays: 'list[np.ndarray]', flags: int, codec: str) -> list:
+    if flags & FLAG_SHM:
+        return [ndarraylist_to_shm(arrays, SHM_DIR)]
+    return ndarraylist_to_buffers(arrays, codec)
+
+
+def do_preprocess(arg: bytearray, flags: int, codec: str) -> list:
     argument_path = arg.decode()
     inputs: list[np.ndarray] = preprocess(argument_path)
-    return ndarraylist_to_bytes(inputs)
+    return encode(inputs, flags, codec)
 
 
-def do_inference(arg: bytes) -> bytes:
+def do_inference(arg: bytearray, flags: int, codec: str) -> list:
     inputs = bytes_to_ndarraylist(arg)
     outputs: list[np.ndarray] = inference(inputs)
-    return ndarraylist_to_bytes(outputs)
+    return encode(outputs, flags, codec)
 
 
-def do_postprocess(arg: bytes) -> bytes:
+def do_postprocess(arg: bytearray, flags: int, codec: str) -> list:
     outputs = bytes_to_ndarraylist(arg)
     result_path = tempfile.mktemp(prefix='ais_')
     postprocess(outputs, result_path)
-    return result_path.encode()
+    return [result_path.encode()]
 
 
 handlers = {
@@ -62,19 +115,189 @@ handlers = {
     CMD_POSTPROCESS: do_postprocess,
 }
 
-while True:
-    conn, addr = sock.accept()  # TODO: Can be async and parallel?
-    command, arg = conn.recv(100000).split(SEPARATOR, 1)  # TODO: Handle large files
+lanes = {}
+
+pending = 0
+pending_lock = threading.Lock()
+
 
+def finish(replies: queue.Queue, request_id: int, future: Future):
+    global pending
+
+    with pending_lock:
+        pending -= 1
+    replies.put((request_id, future))
+
+
+def write_replies(conn: socket.socket, replies: queue.Queue):
     try:
-        if command not in handlers:
-            raise Exception(f'Unknown command: {command}')
-        result = handlers[command](arg)
-    except Exception:
-        tb = traceback.format_exc()
-        conn.sendall(RESP_ERR + SEPARATOR + tb.encode())
+        while True:
+            item = replies.get()
+            if item is None:
+                return
+            request_id, reply = item
+            if isinstance(reply, Future):
+                try:
+                    result = reply.result()
+                except Exception as e:
+                    tb = ''.join(traceback.format_exception(e))
+                    reply = (RESP_ERR, [tb.encode()])
+                else:
+                    reply = (RESP_OK, result)
+            resp, buffers = reply
+            send_frame(conn, resp, *buffers, request_id=request_id)
+    except OSError:
+        # The caller went away
+        traceback.print_exc()
+    finally:
+        conn.close()
+
+
+def serve(conn: socket.socket):
+    global pending
+
+    # Replies are written in completion order by their own thread
+    replies = queue.Queue()
+    threading.Thread(target=write_replies, args=(conn, replies), daemon=True).start()
+
+    codec = RawCodec.name
+    try:
+        while True:
+            command, flags, request_id, arg = recv_frame(conn)
+
+            if command == CMD_PING:
+                state = json.dumps({'pending': pending, 'max_pending': MAX_PENDING})
+                replies.put((request_id, (RESP_OK, [state.encode()])))
+                continue
+
+            if command == CMD_HELLO:
+                codec = negotiate_codec(json.loads(arg)['codecs'])
+                replies.put((request_id, (RESP_OK, [codec.encode()])))
+                continue
+
+            if command not in handlers:
+                replies.put((request_id, (RESP_ERR, [f'Unknown command: {command}'.encode()])))
+                continue
+
+            with pending_lock:
+                busy = pending >= MAX_PENDING
+                if not busy:
+                    pending += 1
+            if busy:
+                state = json.dumps({'pending': pending, 'max_pending': MAX_PENDING})
+                replies.put((request_id, (RESP_BUSY, [state.encode()])))
+                continue
+
+            future = lanes[command].submit(handlers[command], arg, flags, codec)
+            future.add_done_callback(functools.partial(finish, replies, request_id))
+    except ConnectionError:
+        # The caller closed the connection
+        pass
+    except OSError:
+        traceback.print_exc()
+    finally:
+        replies.put(None)
+
+
+def serve_forever(sock: socket.socket):
+    # Pools are started in the serving process, threads do not survive a fork
+    if EXECUTOR == 'process':
+        # Forked after load(), so the pool shares the loaded model
+        stage_pool = ProcessPoolExecutor(CONCURRENCY, mp_context=multiprocessing.get_context('fork'))
+        # Fork every process now, before serving threads exist
+        stage_pool.submit(int).result()
     else:
-        print(f'result size: {len(result)}')
-        conn.sendall(RESP_OK + SEPARATOR + result)
+        stage_pool = ThreadPoolExecutor(CONCURRENCY)
+    # Inference calls are serialised, the model runtime parallelises a single call itself
+    inference_lane = ThreadPoolExecutor(1)
+
+    lanes.update({
+        CMD_PREPROCESS: stage_pool,
+        CMD_INFERENCE: inference_lane,
+        CMD_POSTPROCESS: stage_pool,
+    })
+
+    while True:
+        conn, addr = sock.accept()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+
+def fork_replica(index: int) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+
+    try:
+        sock.close()
+        for other in sockets:
+            if other is not sockets[index]:
+                other.close()
+        serve_forever(sockets[index])
+    finally:
+        os._exit(1)
+
+
+if MAX_REPLICAS == 1:
+    report(STATUS_READY)
+    serve_forever(sock)
+
+replicas = {}  # pid -> index
+replicas_lock = threading.Lock()
+target = REPLICAS
+
+
+def scale(count: int) -> int:
+    global target
+
+    with replicas_lock:
+        target = max(1, min(count, MAX_REPLICAS))
+        running = set(replicas.values())
+        for index in range(target):
+            if index not in running:
+                replicas[fork_replica(index)] = index
+        for pid, index in list(replicas.items()):
+            if index >= target:
+                # The worker stopped sending requests to it
+                del replicas[pid]
+                os.kill(pid, signal.SIGTERM)
+        return target
+
+
+def control(conn: socket.socket):
+    try:
+        while True:
+            command, _, request_id, arg = recv_frame(conn)
+            if command == CMD_SCALE:
+                count = scale(json.loads(arg)['replicas'])
+                reply = (RESP_OK, json.dumps({'replicas': count, 'max_replicas': MAX_REPLICAS}))
+            elif command == CMD_PING:
+                reply = (RESP_OK, json.dumps({'replicas': target, 'max_replicas': MAX_REPLICAS}))
+            else:
+                reply = (RESP_ERR, f'Unknown command: {command}')
+            send_frame(conn, reply[0], reply[1].encode(), request_id=request_id)
+    except ConnectionError:
+        pass
     finally:
         conn.close()
+
+
+def serve_control():
+    while True:
+        conn, addr = sock.accept()
+        threading.Thread(target=control, args=(conn,), daemon=True).start()
+
+
+# Objects from load() are never visited by the collector again, so their pages stay shared
+gc.freeze()
+scale(REPLICAS)
+threading.Thread(target=serve_control, daemon=True).start()
+report(STATUS_READY)
+
+while True:
+    pid, status = os.wait()
+    with replicas_lock:
+        if pid not in replicas:
+            continue
+        index = replicas.pop(pid)
+        print(f'Replica {index} exited with status {status}, restarting it')
+        replicas[fork_replica(index)] = index
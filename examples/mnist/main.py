@@ -8,9 +8,14 @@ import onnxruntime as ort
 def load():
     global session
 
+    # Use as many threads as the worker gave the model cores, 0 lets onnxruntime decide
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = int(os.getenv('AIS_INTRA_OP_THREADS', 0))
+
     # Load the model
     session = ort.InferenceSession(
         os.path.join(os.path.dirname(__file__), "mnist-12.onnx"),
+        options,
         providers=['CPUExecutionProvider'],
     )
 
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import shutil
-import time
 
 import httpx
 
@@ -44,8 +43,8 @@ for job_id in job_ids:
     status = httpx.get(f'http://localhost:8000/jobs/{job_id}').json()
     while status['status'] not in ['completed', 'failed']:
         print(f'Job {job_id} is {status["status"]}')
-        time.sleep(1)
-        status = httpx.get(f'http://localhost:8000/jobs/{job_id}').json()
+        # Answers as soon as the status changes
+        status = httpx.get(f'http://localhost:8000/jobs/{job_id}', params={'wait': 30}, timeout=40).json()
 
     if status['status'] == 'failed':
         print(f'Job {job_id} failed')
@@ -54,3 +53,9 @@ for job_id in job_ids:
         result_path = status['result_path']
         res = httpx.get(f'http://localhost:8000/files/{result_path}')
         print(res.text)
+
+print('Predicting without jobs')
+for file in files:
+    with open(file, 'rb') as f:
+        res = httpx.post(f'http://localhost:8000/models/{model["id"]}/predict', content=f.read(), timeout=30)
+    print(res.text)